@@ -9,10 +9,26 @@ class BadText(Attr):
     def add_bad_reason(self, reason: str):
         assert reason in ["overlap_to_sibling", "bad_title"]
         self.bad_reasons.add(reason)
+        self.node.mark_dirty()
 
     def remove_bad_reason(self, reason: str):
         if reason in self.bad_reasons:
             self.bad_reasons.remove(reason)
+            self.node.mark_dirty()
 
     def has_bad_reason(self, reason: str) -> bool:
         return reason in self.bad_reasons
+
+    def fork(self, node):
+        attr = super().fork(node)
+        attr.bad_reasons = set(self.bad_reasons)
+        return attr
+
+    def serialize(self):
+        return {"bad_reasons": sorted(self.bad_reasons)}
+
+    @classmethod
+    def deserialize(cls, node, payload):
+        attr = cls(node)
+        attr.bad_reasons = set(payload["bad_reasons"])
+        return attr
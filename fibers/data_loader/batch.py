@@ -0,0 +1,112 @@
+from __future__ import annotations
+
+import io
+import itertools
+import os
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, as_completed, wait
+from typing import Any, Callable, Deque, Iterable, Iterator, List, Set, Tuple
+
+from fibers.data_loader.document import Document
+from fibers.data_loader.html_to_tree import html_to_tree
+from fibers.tree import Node
+from fibers.tree.node_id import NodeIdAllocator
+from fibers.tree.persistence import dump_tree, load_tree
+
+"""
+# Batch ingestion
+
+`build_trees` builds trees from many documents in a pool of processes. The
+workers send the trees back in the binary format of `fibers.tree.persistence`,
+which is much smaller and faster to load than pickled nodes.
+
+from fibers.data_loader.batch import build_trees, html_document_to_tree
+articles = (obj["article"] for obj in iter_dataset("QuALITY.v1.0.1.dev"))
+for root in build_trees(articles, html_document_to_tree):
+    ...
+
+`build` must be picklable, e.g. a module-level function or a `functools.partial` of one.
+Attrs that are not serialized (such as `SoupInfo`) do not come back from the workers.
+"""
+
+
+def html_document_to_tree(html: str) -> Node:
+    return html_to_tree(html, keep_soup=False)[0]
+
+
+def json_document_to_tree(file_path: str) -> Node:
+    return Document.from_json(file_path).to_tree()
+
+
+def _init_worker():
+    # Forked workers inherit the id allocator of the parent. Give each one its own namespace
+    Node.id_allocator = NodeIdAllocator()
+
+
+def _build_chunk(build: Callable[[Any], Node], chunk: List[Tuple[int, Any]]) -> List[Tuple[int, bytes]]:
+    res = []
+    for index, document in chunk:
+        f = io.BytesIO()
+        dump_tree(build(document), f)
+        res.append((index, f.getvalue()))
+    return res
+
+
+def build_trees(documents: Iterable, build: Callable[[Any], Node], n_workers: int = None,
+                chunk_size=1, max_in_flight: int = None, ordered=True,
+                with_index=False) -> Iterator[Node]:
+    """
+    Build a tree from each document with `build` in worker processes.
+    :param n_workers: The number of processes. The number of CPUs if None
+    :param chunk_size: The number of documents sent to a worker at once. Raise it for small documents
+    :param max_in_flight: The maximum number of chunks submitted but not yet output.
+    Bounds the memory used when `documents` is a long stream. Twice the number of workers if None
+    :param ordered: Output the trees in the order of `documents`. Otherwise, as soon as they are built
+    :param with_index: Output `(index, root)` pairs, where index is the position of the document
+    :return: An iterator of the roots of the trees
+    """
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    if max_in_flight is None:
+        max_in_flight = 2 * n_workers
+    chunks = _chunked(enumerate(documents), chunk_size)
+    with ProcessPoolExecutor(n_workers, initializer=_init_worker) as executor:
+        if ordered:
+            results = _run_ordered(executor, build, chunks, max_in_flight)
+        else:
+            results = _run_unordered(executor, build, chunks, max_in_flight)
+        for chunk_result in results:
+            for index, data in chunk_result:
+                root = load_tree(data)
+                yield (index, root) if with_index else root
+
+
+def _chunked(iterable: Iterable, size: int) -> Iterator[List]:
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if len(chunk) == 0:
+            return
+        yield chunk
+
+
+def _run_ordered(executor, build, chunks, max_in_flight):
+    in_flight: Deque[Future] = deque()
+    for chunk in chunks:
+        if len(in_flight) >= max_in_flight:
+            yield in_flight.popleft().result()
+        in_flight.append(executor.submit(_build_chunk, build, chunk))
+    while len(in_flight) > 0:
+        yield in_flight.popleft().result()
+
+
+def _run_unordered(executor, build, chunks, max_in_flight):
+    in_flight: Set[Future] = set()
+    for chunk in chunks:
+        if len(in_flight) >= max_in_flight:
+            done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+        in_flight.add(executor.submit(_build_chunk, build, chunk))
+    for future in as_completed(in_flight):
+        yield future.result()
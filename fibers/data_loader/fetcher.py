@@ -0,0 +1,175 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Iterator, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+
+"""
+# Fetching pages
+
+`Fetcher` downloads pages through one pooled `requests.Session`, so
+connections are reused across calls. It retries failed requests with
+exponential backoff. With a `cache_dir`, responses are kept on disk, and a
+cached page is revalidated with its ETag / Last-Modified. A 304 answer means
+the cached body is used without downloading it again.
+
+The transport is anything with the `get(url, headers=..., timeout=...)` of
+`requests.Session`, returning an object with `status_code`, `headers`,
+`content` and `encoding`. Pass another one to test against a local stand-in.
+
+fetcher = Fetcher(cache_dir="~/.cache/fibers/pages")
+for url, html in fetcher.fetch_many(urls):
+    ...
+"""
+
+DEFAULT_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_10_1) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/39.0.2171.95 Safari/537.36'}
+
+# Statuses worth retrying
+_retry_statuses = {429, 500, 502, 503, 504}
+
+
+def pooled_session(pool_size=16) -> requests.Session:
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+class FetchError(Exception):
+    def __init__(self, url: str, status_code: int):
+        super().__init__(f"Fetching {url} failed with status {status_code}")
+        self.url = url
+        self.status_code = status_code
+
+
+class Fetcher:
+    def __init__(self, transport=None, cache_dir: str = None, headers: Dict[str, str] = None,
+                 timeout=30.0, retries=3, backoff=0.5, max_workers=8):
+        """
+        :param transport: The object making the requests. A pooled `requests.Session` if None
+        :param cache_dir: The directory of the response cache. No caching if None
+        :param timeout: The timeout of each request in seconds
+        :param retries: The number of retries after a connection error or a 429/5xx status
+        :param backoff: The delay before the first retry in seconds. It doubles at each retry
+        :param max_workers: The number of concurrent requests of `fetch_many`
+        """
+        self.transport = transport if transport is not None else pooled_session(max_workers)
+        self.cache_dir = os.path.expanduser(cache_dir) if cache_dir is not None else None
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+        self.headers = headers if headers is not None else DEFAULT_HEADERS
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_workers = max_workers
+
+    def fetch(self, url: str) -> str:
+        """
+        :return: The text of the page at `url`
+        """
+        cached = self._read_cache(url)
+        headers = dict(self.headers)
+        if cached is not None:
+            meta, _ = cached
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                headers["If-Modified-Since"] = meta["last_modified"]
+        response = self._get(url, headers)
+        if response.status_code == 304 and cached is not None:
+            meta, body = cached
+            return body.decode(meta["encoding"], errors="replace")
+        if response.status_code >= 400:
+            raise FetchError(url, response.status_code)
+        encoding = response.encoding or "utf-8"
+        if self.cache_dir is not None:
+            self._write_cache(url, response, encoding)
+        return response.content.decode(encoding, errors="replace")
+
+    def fetch_many(self, urls: Iterable[str], max_workers: int = None) -> Iterator[Tuple[str, str | Exception]]:
+        """
+        Fetch the urls concurrently.
+        :return: An iterator of (url, text) in the order of `urls`. The text is the exception if the fetch failed
+        """
+        def fetch(url):
+            try:
+                return url, self.fetch(url)
+            except Exception as e:
+                return url, e
+
+        with ThreadPoolExecutor(max_workers or self.max_workers) as executor:
+            yield from executor.map(fetch, urls)
+
+    def _get(self, url: str, headers: Dict[str, str]):
+        delay = self.backoff
+        for attempt in range(self.retries + 1):
+            last_attempt = attempt == self.retries
+            try:
+                response = self.transport.get(url, headers=headers, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout):
+                if last_attempt:
+                    raise
+            else:
+                if response.status_code not in _retry_statuses or last_attempt:
+                    return response
+            time.sleep(delay)
+            delay *= 2
+
+    """
+    ## Cache
+    """
+
+    def _cache_path(self, url: str) -> str:
+        return os.path.join(self.cache_dir, hashlib.sha256(url.encode("utf-8")).hexdigest())
+
+    def _read_cache(self, url: str) -> Tuple[Dict, bytes] | None:
+        if self.cache_dir is None:
+            return None
+        path = self._cache_path(url)
+        try:
+            with open(path + ".json", "r") as f:
+                meta = json.load(f)
+            with open(path + ".body", "rb") as f:
+                body = f.read()
+        except (OSError, ValueError):
+            return None
+        if meta.get("url") != url or meta.get("size") != len(body):
+            return None
+        return meta, body
+
+    def _write_cache(self, url: str, response, encoding: str):
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        if etag is None and last_modified is None:
+            # The page cannot be revalidated
+            return
+        path = self._cache_path(url)
+        body = response.content
+        meta = {"url": url, "etag": etag, "last_modified": last_modified, "encoding": encoding,
+                "size": len(body)}
+        # Write to temporary files and rename them, so that a crash never leaves a partial entry.
+        # The body goes first, and the size in the metadata rejects a body from another response
+        for suffix, data in [(".body", body), (".json", json.dumps(meta).encode("utf-8"))]:
+            tmp_path = f"{path}{suffix}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path + suffix)
+
+
+_default_fetcher: Fetcher | None = None
+
+
+def default_fetcher() -> Fetcher:
+    global _default_fetcher
+    if _default_fetcher is None:
+        _default_fetcher = Fetcher()
+    return _default_fetcher
@@ -0,0 +1,309 @@
+from __future__ import annotations
+
+import codecs
+import html
+from html.parser import HTMLParser
+from typing import IO, Iterable, Iterator, List, Tuple
+
+from fibers.data_loader.html_to_tree import ARTICLE_TAGS, CONTAINER_TAGS, SectionBuilder, SoupInfo, \
+    init_soup_info, parse_html, pre_process_html_tree
+from fibers.tree import Node
+
+"""
+# Streaming HTML ingestion
+
+`stream_html_to_tree` builds the same kind of tree as `html_to_tree` while
+reading the page chunk by chunk, without holding the whole document in memory.
+
+Instead of scoring every container after parsing, the containers are scored as
+they are read. The first container with `lock_threshold` article elements
+(p, h1-h6, blockquote) as direct children becomes the article root. From then
+on, each direct child of the root is parsed on its own and added to the tree
+as soon as it is closed, so only the current element is kept in memory. If no
+container reaches the threshold, the one with the most article elements is used
+when the input ends, as in `extract_article_root`.
+
+With `keep_soup=False`, the nodes get plain string contents and no `SoupInfo`,
+so the tree does not hold a parsed copy of the page either.
+"""
+
+VOID_TAGS = {"area", "base", "br", "col", "embed", "hr", "img", "input", "link", "meta", "param",
+             "source", "track", "wbr"}
+
+
+class _Container:
+    __slots__ = ("n_article_elements", "children", "child_start", "text_child")
+
+    def __init__(self):
+        self.n_article_elements = 0
+        # The (start, end) ranges in the buffer of the closed direct children
+        self.children: List[Tuple[int, int]] = []
+        # The buffer index where the direct child being read starts
+        self.child_start: int | None = None
+        # Whether the last direct child is text, so that following text joins it
+        self.text_child = False
+
+
+class HtmlTreeStream(HTMLParser):
+    """
+    Build a tree from html fed in chunks.
+
+    stream = HtmlTreeStream()
+    for chunk in chunks:
+        new_nodes = stream.feed(chunk)
+    root = stream.close()
+    """
+
+    def __init__(self, lock_threshold=8, keep_soup=True):
+        super().__init__(convert_charrefs=False)
+        self.lock_threshold = lock_threshold
+        self.keep_soup = keep_soup
+        # The raw html of the elements that might still be output
+        self.buffer: List[str] = []
+        # The open elements as (tag, container or None)
+        self.stack: List[Tuple[str, _Container | None]] = []
+        self.containers: List[_Container] = []
+        self.article_root: _Container | None = None
+        # The depth of the article root in the stack. Elements outside it are not recorded after it is chosen
+        self.article_root_depth = -1
+        self.finished = False
+        self.title_parts: List[str] | None = None
+        self.title: str | None = None
+        self.builder: SectionBuilder | None = None
+        self.new_nodes: List[Node] = []
+
+    def feed(self, data: str) -> List[Node]:
+        """
+        :return: The nodes added to the tree for this chunk
+        """
+        super().feed(data)
+        return self._take_new_nodes()
+
+    def close(self) -> Node:
+        """
+        :return: The root of the tree
+        """
+        super().close()
+        while len(self.stack) > 0:
+            self._pop()
+        if self.article_root is None and len(self.containers) > 0:
+            best = max(self.containers, key=lambda container: container.n_article_elements)
+            self._lock(best)
+        root = self._get_builder().root
+        if self.keep_soup:
+            init_soup_info(root, "html.parser")
+        return root
+
+    """
+    ## Recording
+    """
+
+    def _recording(self) -> bool:
+        if self.finished:
+            return False
+        return self.article_root is None or len(self.stack) >= self.article_root_depth
+
+    def _parent_container(self) -> _Container | None:
+        if len(self.stack) == 0:
+            return None
+        container = self.stack[-1][1]
+        if self.article_root is not None and container is not self.article_root:
+            return None
+        return container
+
+    def _add_text(self, text: str):
+        if not self._recording():
+            return
+        container = self._parent_container()
+        if container is not None and not container.text_child:
+            self._end_child(container)
+            container.child_start = len(self.buffer)
+            container.text_child = True
+        self.buffer.append(text)
+
+    def _start_child(self, tag: str):
+        container = self._parent_container()
+        if container is None:
+            return
+        self._end_child(container)
+        container.child_start = len(self.buffer)
+        if tag in ARTICLE_TAGS:
+            container.n_article_elements += 1
+            if self.article_root is None and container.n_article_elements >= self.lock_threshold:
+                self._lock(container)
+
+    def _end_child(self, container: _Container):
+        """
+        Close the direct child of `container` being read, if any
+        """
+        if container.child_start is None:
+            return
+        container.children.append((container.child_start, len(self.buffer)))
+        container.child_start = None
+        container.text_child = False
+        if container is self.article_root:
+            self._emit_children()
+
+    def _pop(self):
+        tag, container = self.stack.pop()
+        if self._recording() and tag not in VOID_TAGS:
+            self.buffer.append(f"</{tag}>")
+        if container is not None:
+            self._end_child(container)
+            if container is self.article_root:
+                self.finished = True
+                self.buffer = []
+        parent = self._parent_container()
+        if parent is not None and not self.finished:
+            self._end_child(parent)
+
+    """
+    ## Article root
+    """
+
+    def _lock(self, container: _Container):
+        self.article_root = container
+        for depth, (_, open_container) in enumerate(self.stack):
+            if open_container is container:
+                self.article_root_depth = depth + 1
+                break
+        else:
+            # Chosen after it was closed
+            self.finished = True
+        self.containers = []
+        self._emit_children()
+
+    def _emit_children(self):
+        """
+        Add the closed children of the article root to the tree and drop them from the buffer
+        """
+        root = self.article_root
+        for start, end in root.children:
+            self._add_segment("".join(self.buffer[start:end]))
+        root.children = []
+        # Keep only the child being read
+        if root.child_start is None:
+            self.buffer = []
+        else:
+            self.buffer = self.buffer[root.child_start:]
+            root.child_start = 0
+
+    def _add_segment(self, segment: str):
+        soup = parse_html(segment, "html.parser")
+        pre_process_html_tree(soup)
+        builder = self._get_builder()
+        for element in list(soup.children):
+            nodes = builder.add(element)
+            if not self.keep_soup:
+                for node in nodes:
+                    if node.attrs.pop(SoupInfo, None) is not None:
+                        node.content = node.content
+            self.new_nodes.extend(nodes)
+
+    def _get_builder(self) -> SectionBuilder:
+        if self.builder is None:
+            self.builder = SectionBuilder(self.title or "")
+        return self.builder
+
+    def _take_new_nodes(self) -> List[Node]:
+        new_nodes = self.new_nodes
+        self.new_nodes = []
+        return new_nodes
+
+    """
+    ## HTMLParser events
+    """
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "title" and self.title is None:
+            self.title_parts = []
+        if not self._recording():
+            return
+        self._start_child(tag)
+        self.buffer.append(self.get_starttag_text())
+        if tag in VOID_TAGS:
+            container = self._parent_container()
+            if container is not None:
+                self._end_child(container)
+            return
+        container = None
+        if tag in CONTAINER_TAGS and self.article_root is None:
+            container = _Container()
+            self.containers.append(container)
+        self.stack.append((tag, container))
+
+    def handle_startendtag(self, tag, attrs):
+        if not self._recording():
+            return
+        self._start_child(tag)
+        self.buffer.append(self.get_starttag_text())
+        container = self._parent_container()
+        if container is not None:
+            self._end_child(container)
+
+    def handle_endtag(self, tag):
+        if tag == "title" and self.title_parts is not None:
+            self.title = html.unescape("".join(self.title_parts))
+            self.title_parts = None
+        if not any(open_tag == tag for open_tag, _ in self.stack):
+            # A stray end tag
+            return
+        while True:
+            open_tag, _ = self.stack[-1]
+            self._pop()
+            if open_tag == tag:
+                break
+
+    def handle_data(self, data):
+        if self.title_parts is not None:
+            self.title_parts.append(data)
+        self._add_text(data)
+
+    def handle_entityref(self, name):
+        self.handle_data(f"&{name};")
+
+    def handle_charref(self, name):
+        self.handle_data(f"&#{name};")
+
+    def handle_comment(self, data):
+        self._add_text(f"<!--{data}-->")
+        container = self._parent_container()
+        if container is not None and self._recording():
+            self._end_child(container)
+
+
+def _iter_text(source: str | IO | Iterable[str | bytes], chunk_size: int, encoding: str) -> Iterator[str]:
+    if isinstance(source, str):
+        yield source
+        return
+    if hasattr(source, "read"):
+        f = source
+        chunks = iter(lambda: f.read(chunk_size), f.read(0))
+    else:
+        chunks = source
+    decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+    for chunk in chunks:
+        if isinstance(chunk, bytes):
+            chunk = decoder.decode(chunk)
+        if len(chunk) > 0:
+            yield chunk
+    rest = decoder.decode(b"", final=True)
+    if len(rest) > 0:
+        yield rest
+
+
+def stream_html_to_tree(source: str | IO | Iterable[str | bytes], lock_threshold=8, keep_soup=True,
+                        chunk_size=1 << 16, encoding="utf-8") -> Node:
+    """
+    Build a tree like `html_to_tree` while reading `source` incrementally.
+    :param source: The html, a file object opened in text or binary mode, or an iterator of chunks
+    :param lock_threshold: The number of article elements that makes a container the article root
+    :param keep_soup: Keep the `SoupInfo` of the nodes. Otherwise the contents are rendered to strings right away
+    :param chunk_size: The number of bytes or characters read from a file object at a time
+    :param encoding: The encoding of byte input
+    :return: The root of the tree
+    """
+    stream = HtmlTreeStream(lock_threshold, keep_soup)
+    for chunk in _iter_text(source, chunk_size, encoding):
+        stream.feed(chunk)
+    return stream.close()
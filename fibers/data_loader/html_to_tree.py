@@ -1,38 +1,130 @@
-import base64
+import hashlib
 import html
 import os
 import re
-from typing import List
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from copy import copy
+from typing import Iterator, List, Tuple
 
 import html2text
-import requests
-from bs4 import BeautifulSoup, PageElement, Tag
+from bs4 import BeautifulSoup, NavigableString, PageElement, Tag
 
 from fibers.data_loader.bad_text_attr import BadText
+from fibers.data_loader.fetcher import Fetcher, default_fetcher
+from fibers.data_loader.image_cache import IMAGE_REF_PREFIX, ImageCache, ImageRefs, ImageStore, \
+    default_image_cache
 from fibers.tree import Node
+from fibers.tree.node import LazyContent
 from fibers.tree.node_attr import Attr
 
+try:
+    import lxml
+    # The C-backed parser is several times faster than html.parser.
+    # Both give the same trees for well-formed pages, but they repair malformed html differently,
+    # so installing lxml changes the trees of such pages. Pass parser="html.parser" to keep the old trees
+    default_parser = "lxml"
+except ImportError:
+    default_parser = "html.parser"
+
+_document_tag_pattern = re.compile(r"<(html|head|body)[\s>/]", re.IGNORECASE)
+
+
+def parse_html(html: str, parser: str = None) -> BeautifulSoup:
+    """
+    Parse `html` with `parser`, one of the tree builders of BeautifulSoup ("lxml", "html5lib" or "html.parser").
+    The html, head and body tags that the parser adds around a fragment are removed, so fragments
+    get the same tree as with html.parser.
+    The parsers differ on malformed html: e.g. `<p>one<p>two` gives two paragraphs with lxml,
+    as in browsers, but nested paragraphs with html.parser.
+    :param parser: `default_parser` if None
+    """
+    parser = parser or default_parser
+    soup = BeautifulSoup(html, parser)
+    if parser != "html.parser" and not _document_tag_pattern.search(html):
+        for name in ["head", "body", "html"]:
+            tag = soup.find(name)
+            if tag is not None:
+                tag.unwrap()
+    return soup
+
+
+class SoupContent(LazyContent):
+    """
+    The content of a node rendered from its soup when it is first read.
+    Call `invalidate` after changing the soup.
+    """
+
+    __slots__ = ("soup", "escape", "_rendered")
+
+    def __init__(self, soup: BeautifulSoup, escape=False):
+        self.soup = soup
+        # Whether to render the soup as escaped text
+        self.escape = escape
+        self._rendered: str | None = None
+
+    def materialize(self) -> str:
+        if self._rendered is None:
+            rendered = str(self.soup)
+            self._rendered = html.escape(rendered) if self.escape else rendered
+        return self._rendered
+
+    def invalidate(self):
+        self._rendered = None
+
 
 class SoupInfo(Attr):
     def __init__(self, soup: BeautifulSoup, node: Node):
         super().__init__(node)
         self.soup = soup
 
+    def fork(self, node: Node):
+        attr = super().fork(node)
+        attr.soup = copy(self.soup)
+        return attr
+
+    def follows_soup(self, escape=False) -> bool:
+        """
+        :return: Whether the content of the node is rendered from the soup, escaped as `escape`
+        """
+        content = self.node._content
+        return isinstance(content, SoupContent) and content.soup is self.soup and content.escape == escape
+
+    def update_content(self, escape=False):
+        """
+        Make the content of the node follow the soup again after the soup changed
+        """
+        if self.follows_soup(escape):
+            self.node._content.invalidate()
+            self.node.mark_dirty()
+        else:
+            self.node.content = SoupContent(self.soup, escape)
+
     @staticmethod
     def soup_to_content(root: Node):
         for node in root.iter_subtree_with_dfs():
-            node.content = str(SoupInfo.get(node).soup)
+            SoupInfo.get(node).update_content()
 
 
-def url_to_tree(url: str) -> (Node, BeautifulSoup):
-    browser_headers = {
-        'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_10_1) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/39.0.2171.95 Safari/537.36'}
-    html = requests.get(url, headers=browser_headers).text
-    return html_to_tree(html)
+def url_to_tree(url: str, parser: str = None, fetcher: Fetcher = None, keep_soup=True) -> (Node, BeautifulSoup):
+    """
+    :param fetcher: The fetcher downloading the page. A shared one without cache if None
+    :param keep_soup: See `html_to_tree`
+    """
+    fetcher = fetcher or default_fetcher()
+    return html_to_tree(fetcher.fetch(url), parser=parser, keep_soup=keep_soup)
 
 
-def html_to_tree(html: str, to_markdown=False) -> (Node, BeautifulSoup):
-    soup = BeautifulSoup(html, "html.parser")
+def html_to_tree(html: str, to_markdown=False, parser: str = None, keep_soup=True) -> (Node, BeautifulSoup):
+    """
+    :param parser: The parser backend. See `parse_html`
+    :param keep_soup: Return the soup of the whole page. The tree is then built from a copy of the
+    article, which takes about 40% longer. Otherwise the elements of the article are moved into the
+    nodes and None is returned instead of the soup
+    :return: The root of the tree and the soup of the page
+    """
+    soup = parse_html(html, parser)
     pre_process_html_tree(soup)
     title = soup.find("title")
     if title:
@@ -40,198 +132,420 @@ def html_to_tree(html: str, to_markdown=False) -> (Node, BeautifulSoup):
     else:
         title = ""
     root = extract_article_root(soup)
+    if keep_soup:
+        root = copy(root)
     root = html_to_raw_tree(root, title=title)
-    init_soup_info(root)
+    init_soup_info(root, parser)
     if to_markdown:
         html_to_markdown(root)
-    return root, soup
+    return root, soup if keep_soup else None
 
 
-def init_soup_info(root: Node):
+def init_soup_info(root: Node, parser: str = None):
+    """
+    Add a SoupInfo to the nodes that do not have one by parsing their content.
+    The nodes made by `html_to_raw_tree` already keep their part of the original soup.
+    """
     for node in root.iter_subtree_with_dfs():
-        soup = BeautifulSoup(node.content, "html.parser")
-        if node.has_attr(SoupInfo):
-            node.get_attr(SoupInfo).soup = soup
-        else:
-            SoupInfo(soup, node)
+        if not node.has_attr(SoupInfo):
+            SoupInfo(parse_html(node.content, parser), node)
 
 
-def pre_process_html_tree(soup: BeautifulSoup):
-    href_tags = soup.find_all('a', href=True)
-    for href_tag in href_tags:
-        href_tag['target'] = '_blank'
-    for script in soup(["script", "style"]):
-        # remove all javascript and stylesheet code
-        script.decompose()
-    redundant_tags = soup.find_all(class_=lambda x: x and 'gsl_pagenum' in x, recursive=True)
-    for tag in redundant_tags:
-        if tag.parent and tag.parent.name == 'h2':
-            tag.decompose()
+class SoupTransform:
+    """
+    An operation of `transform_soup`. `visit` is called on every tag once, parents before children.
+    """
 
-    herf_tags = soup.find_all('a', recursive=True)
-    for tag in herf_tags:
-        if isinstance(tag, Tag) and tag.get('href') is not None and re.match(r'^/scholar_case.+$', tag.get('href')):
-            tag['href'] = "https://scholar.google.com" + tag.get('href')
+    def visit(self, tag: Tag) -> bool | str:
+        """
+        :return: REMOVE or UNWRAP to remove or unwrap the tag, otherwise whether the tag was changed
+        """
+        raise NotImplementedError
 
 
+REMOVE = "remove"
+UNWRAP = "unwrap"
 
 
+class RemoveAttrs(SoupTransform):
+    def __init__(self, attrs_to_keep: List[str]):
+        self.attrs_to_keep = set(attrs_to_keep)
 
+    def visit(self, tag: Tag):
+        attrs = tag.attrs
+        to_remove = [attr for attr in attrs if attr not in self.attrs_to_keep]
+        for attr in to_remove:
+            del attrs[attr]
+        return len(to_remove) > 0
 
-def remove_attrs(root: Node, attrs_to_keep: List[str]):
+
+class RemoveElements(SoupTransform):
+    def __init__(self, elements: List[str]):
+        self.elements = set(elements)
+
+    def visit(self, tag: Tag):
+        return REMOVE if tag.name in self.elements else False
+
+
+class UnwrapElements(SoupTransform):
+    def __init__(self, elements: List[str]):
+        self.elements = set(elements)
+
+    def visit(self, tag: Tag):
+        return UNWRAP if tag.name in self.elements else False
+
+
+class InlineImages(SoupTransform):
+    """
+    Replace the src of images with base64 data urls, or with references to `store` if given
+    """
+
+    def __init__(self, base_path="", cache: ImageCache = None, store: ImageStore = None):
+        self.base_path = base_path
+        self.cache = cache or default_image_cache
+        self.store = store
+
+    def image_path(self, tag: Tag) -> str | None:
+        """
+        :return: The path of the image file of `tag`, or None if it is not a file image
+        """
+        if tag.name != "img":
+            return None
+        src = tag.get("src")
+        if src is None or src.startswith("data:") or src.startswith(IMAGE_REF_PREFIX):
+            return None
+        return os.path.join(self.base_path, src)
+
+    def visit(self, tag: Tag):
+        path = self.image_path(tag)
+        if path is None:
+            return False
+        digest, data_url = self.cache.get(path)
+        tag["src"] = data_url if self.store is None else self.store.add(digest, data_url)
+        return True
+
+
+def transform_soup(soup: BeautifulSoup | Tag, transforms: List[SoupTransform]) -> bool:
+    """
+    Apply all the transforms in one walk over the tags of `soup`.
+    On each tag, the transforms run in order until one of them removes or unwraps it.
+    :return: Whether anything changed
+    """
+    changed = False
+    stack = [child for child in reversed(soup.contents) if isinstance(child, Tag)]
+    while len(stack) > 0:
+        tag = stack.pop()
+        action = None
+        for transform in transforms:
+            result = transform.visit(tag)
+            if result is REMOVE or result is UNWRAP:
+                action = result
+                break
+            changed = changed or result
+        if action is REMOVE:
+            tag.decompose()
+            changed = True
+            continue
+        stack.extend(child for child in reversed(tag.contents) if isinstance(child, Tag))
+        if action is UNWRAP:
+            tag.unwrap()
+            changed = True
+    return changed
+
+
+def transform_tree(root: Node, transforms: List[SoupTransform], escape=False):
+    """
+    Apply the transforms to the soup of every node in the subtree of `root`.
+    The content of a node is only rendered again if its soup changed, or if it was not rendered
+    from the soup with the same `escape`, so that all the contents end up in the same encoding.
+    :param escape: Set the contents to the escaped html of the soups, for all the nodes
+    """
     for node in root.iter_subtree_with_dfs():
-        soup = SoupInfo.get(node).soup
-        for ele in soup.descendants:
-            if ele.name:
-                for attr in list(ele.attrs):
-                    if attr not in attrs_to_keep:
-                        del ele.attrs[attr]
-        node.content = html.escape(str(soup))
+        soup_info = SoupInfo.get(node)
+        if transform_soup(soup_info.soup, transforms) or not soup_info.follows_soup(escape):
+            soup_info.update_content(escape)
+
+
+class _PreProcess(SoupTransform):
+    scholar_case_pattern = re.compile(r'^/scholar_case.+$')
+
+    def visit(self, tag: Tag):
+        name = tag.name
+        if name in ("script", "style"):
+            # remove all javascript and stylesheet code
+            return REMOVE
+        parent = tag.parent
+        if parent is not None and parent.name == "h2":
+            if any("gsl_pagenum" in class_name for class_name in tag.get("class", ())):
+                return REMOVE
+        if name == "a":
+            href = tag.get("href")
+            if href is None:
+                return False
+            tag["target"] = "_blank"
+            if self.scholar_case_pattern.match(href):
+                tag["href"] = "https://scholar.google.com" + href
+            return True
+        return False
+
+
+def pre_process_html_tree(soup: BeautifulSoup):
+    transform_soup(soup, [_PreProcess()])
+
+
+def remove_attrs(root: Node, attrs_to_keep: List[str]):
+    transform_tree(root, [RemoveAttrs(attrs_to_keep)], escape=True)
+
 
 def remove_elements(root: Node, elements: List[str]):
-    for node in root.iter_subtree_with_dfs():
-        soup = SoupInfo.get(node).soup
-        for ele in soup.find_all(elements):
-            ele.decompose()
-        node.content = str(soup)
+    transform_tree(root, [RemoveElements(elements)])
 
 
 def unwrap_elements(root: Node, elements: List[str]):
-    for node in root.iter_subtree_with_dfs():
-        soup = SoupInfo.get(node).soup
-        for ele in soup.find_all(elements):
-            ele.unwrap()
-        node.content = str(soup)
+    transform_tree(root, [UnwrapElements(elements)])
 
 
-def image_to_base64_on_tree(root: Node, base_path=""):
+def image_to_base64_on_tree(root: Node, base_path="", max_workers=8, by_reference=False,
+                            cache: ImageCache = None):
+    """
+    :param max_workers: The number of threads reading the image files
+    :param by_reference: Store each image once in the `ImageStore` of `root` and refer to it by hash
+    :param cache: The cache of the encoded images. `default_image_cache` if None
+    """
+    store = ImageStore.get(root) if by_reference else None
+    inline_images = InlineImages(base_path, cache, store)
+    paths = []
     for node in root.iter_subtree_with_dfs():
-        soup = SoupInfo.get(node).soup
-        image_to_base64(soup, base_path)
+        node_paths = [path for path in map(inline_images.image_path, SoupInfo.get(node).soup.find_all("img"))
+                      if path is not None]
+        if by_reference and len(node_paths) > 0 and not node.has_attr(ImageRefs):
+            # Resolve the references when the node is rendered
+            ImageRefs(node)
+        paths.extend(node_paths)
+    inline_images.cache.load_many(paths, max_workers)
+    transform_tree(root, [inline_images])
 
-def image_to_base64(soup: BeautifulSoup, base_path):
-    img_elements = soup.find_all("img")
-    for img_element in img_elements:
-        # get src of img element
-        src = img_element.get("src")
-        if src.startswith("data:image"):
-            continue
-        src = os.path.join(base_path, src)
-        # open image file
-        with open(src, "rb") as f:
-            # convert image to base64
-            base64_img = base64.b64encode(f.read()).decode("utf-8")
-            # replace src with base64
-            img_element["src"] = f"data:image/png;base64,{base64_img}"
 
+def image_to_base64(soup: BeautifulSoup, base_path):
+    transform_soup(soup, [InlineImages(base_path)])
 
 
 def html_to_raw_tree(soup: BeautifulSoup, title="") -> Node:
+    """
+    Build a tree from the headings of `soup`. The elements between headings are moved
+    out of `soup` into the soups of the new nodes, so `soup` is not parsed again.
+    `soup` is left without them. Pass a copy to keep it whole.
+    """
+    builder = SectionBuilder(title)
+    # Copy the children because set_content moves them out of the soup
+    for element in list(soup.children):
+        builder.add(element)
+    return builder.root
+
+
+class SectionBuilder:
+    """
+    Build the tree of `html_to_raw_tree` one top-level element at a time.
+    """
+
     hn_pattern = re.compile(r"h[1-6]")
-    root = Node()
-    curr_node = root.s(title)
-    node_stack = []
-    curr_content: List[PageElement] = []
-    curr_level = -1
-    for child in soup.children:
-        child = unwrap_useless_tags(child)
+
+    def __init__(self, title=""):
+        self.root = Node()
+        self.curr_node = self.root.s(title)
+        self.node_stack = []
+        self.curr_level = -1
+
+    def add(self, element: PageElement) -> List[Node]:
+        """
+        :return: The nodes added for `element`
+        """
+        unwrapped = unwrap_useless_tags(element)
+        child = unwrapped[0] if len(unwrapped) == 1 else None
         # check whether it's hn use regex
-        if hasattr(child, "name") and child.name and hn_pattern.match(child.name):
-            set_content(curr_node, curr_content)
-            this_level = int(child.name[1])
-            if this_level > curr_level:
-                new_node = curr_node.s(child.text.strip())
-                node_stack.append((curr_node, this_level))
-            else:
-                while len(node_stack) > 0 and node_stack[-1][1] > this_level:
-                    node_stack.pop()
-                parent_node = node_stack[-1][0]
-                new_node = parent_node.s(child.text.strip())
-
-            curr_content = []
-            curr_level = this_level
-            curr_node = new_node
+        if child is None or not child.name or not self.hn_pattern.match(child.name):
+            return set_content(self.curr_node, [element])
+        return [self.add_heading(int(child.name[1]), child.text.strip())]
+
+    def add_heading(self, this_level: int, title: str) -> Node:
+        """
+        Add the node of a heading of level `this_level`. The following contents go under it
+        """
+        if this_level > self.curr_level:
+            new_node = self.curr_node.s(title)
+            self.node_stack.append((self.curr_node, this_level))
         else:
-            curr_content.append(child)
-    set_content(curr_node, curr_content)
-
-    return root
-
-def set_content(node: Node, contents: List[PageElement]):
-    segment_contents = [""]
+            # The first entry holds the title node, which stays the parent of the shallowest headings
+            while len(self.node_stack) > 1 and self.node_stack[-1][1] > this_level:
+                self.node_stack.pop()
+            parent_node = self.node_stack[-1][0]
+            new_node = parent_node.s(title)
+        self.curr_level = this_level
+        self.curr_node = new_node
+        return new_node
+
+    def add_text(self, content: str) -> Node:
+        """
+        Add a content node under the current heading
+        """
+        return new_segment_node(self.curr_node, content)
+
+
+def set_content(node: Node, contents: List[PageElement]) -> List[Node]:
+    """
+    Add a child to `node` for each non-empty element in `contents`. The element is moved
+    into the soup of the child, and the content of the child is rendered from it when read.
+    :return: The children added
+    """
+    nodes_added = []
     for segment in contents:
-        segment = unwrap_useless_tags(segment)
-        segment = str(segment)
-        if len(segment.strip()) == 0:
+        elements = unwrap_useless_tags(segment)
+        if all(isinstance(ele, NavigableString) and len(ele.strip()) == 0 for ele in elements):
             continue
-        segment_contents.append(segment)
+        fragment = BeautifulSoup("", "html.parser")
+        for ele in elements:
+            fragment.append(ele)
+        node_added = new_segment_node(node, SoupContent(fragment))
+        SoupInfo(fragment, node_added)
+        nodes_added.append(node_added)
+    return nodes_added
 
-    if segment_contents[0] == "":
-        segment_contents.pop(0)
 
-    for i, segment in enumerate(segment_contents):
-        node_added = node.s(f"").be(segment)
-        bad_text_attr = BadText.get(node_added)
-        bad_text_attr.add_bad_reason("overlap_to_sibling")
-        bad_text_attr.add_bad_reason("bad_title")
+def new_segment_node(parent: Node, content: str | SoupContent) -> Node:
+    """
+    :return: A new untitled child of `parent` holding a segment of the document
+    """
+    node_added = parent.s(f"").be(content)
+    bad_text_attr = BadText.get(node_added)
+    bad_text_attr.add_bad_reason("overlap_to_sibling")
+    bad_text_attr.add_bad_reason("bad_title")
+    return node_added
+
+
+def unwrap_useless_tags(content: PageElement) -> List[PageElement]:
+    """
+    :return: The elements that `content` stands for after removing the p, div and span wrapping a single element
+    """
+    while content.name in ["p", "div", "span"]:
+        if len(content.contents) != 1:
+            return list(content.contents)
+        content = content.contents[0]
+    return [content]
 
 
-def unwrap_useless_tags(content: PageElement):
-    if not hasattr(content, "name"):
-        return content
-    if content.name in ["p", "div", "span"]:
-        # return all children
-        if len(content.contents) == 1:
-            return unwrap_useless_tags(content.contents[0])
-        return "".join([str(child) for child in content.children])
-    return content
+_bfs_tags = {"html", "body", "div", "article", "main", "span"}
+CONTAINER_TAGS = {"div", "article", "html", "body", "main"}
+ARTICLE_TAGS = {"p", "h1", "h2", "h3", "h4", "h5", "h6", "blockquote"}
 
 
-def bfs_on_soup(soup: BeautifulSoup):
-    queue = [([], soup)]  # queue of (path, element) pairs
+def bfs_on_soup(soup: BeautifulSoup) -> Iterator[Tuple[List[str], Tag]]:
+    """
+    Iterate the html, body, div, article, main and span elements of `soup` in breadth-first order.
+    Only the children of these elements are visited.
+    :return: An iterator of (path, element), where path holds the names of the elements above `element`
+    """
+    queue = deque([([], soup)])
     while queue:
-        path, element = queue.pop(0)
-        if hasattr(element, 'children'):  # check for leaf elements
-            for child in element.children:
-                if child.name in ["html", "body", "div", "article", "main", "span"]:
-                    queue.append(
-                        (path + [child.name if child.name is not None else type(child)],
-                         child))
-                    yield path, child
+        path, element = queue.popleft()
+        for child in element.children:
+            if child.name in _bfs_tags:
+                queue.append((path + [child.name], child))
+                yield path, child
 
 
 def extract_article_root(soup: BeautifulSoup):
     """
     Extract the element with most article related elements, including p, h1, h2, h3, h4, h5, h6
     """
-    n_article_elements = []
-    elements = []
-    for path, element in bfs_on_soup(soup):
-        if element.name in ["div", "article", "html", "body", "main"]:
-            elements.append(element)
-            # count the number of article related elements
-            n_article_elements_here = 0
-            for child in element.children:
-                if child.name in ["p", "h1", "h2", "h3", "h4", "h5", "h6", "blockquote"]:
-                    n_article_elements_here += 1
-            n_article_elements.append(n_article_elements_here)
-            #print(n_article_elements_here, element.name, element.get("class"), element.get("id"))
-    # find the div with the most article related elements
-    max_n_article_elements = max(n_article_elements)
-    max_n_article_elements_index = n_article_elements.index(max_n_article_elements)
-    article_root = elements[max_n_article_elements_index]
+    article_root = None
+    max_n_article_elements = -1
+    queue = deque([soup])
+    while queue:
+        element = queue.popleft()
+        # count the number of article related elements
+        n_article_elements_here = 0
+        for child in element.children:
+            name = child.name
+            if name in ARTICLE_TAGS:
+                n_article_elements_here += 1
+            elif name in _bfs_tags:
+                queue.append(child)
+        # keep the first element with the most article related elements
+        if element is not soup and element.name in CONTAINER_TAGS \
+                and n_article_elements_here > max_n_article_elements:
+            article_root = element
+            max_n_article_elements = n_article_elements_here
+    if article_root is None:
+        return soup
     return article_root
 
 
-html2text_handler = html2text.HTML2Text()
-html2text_handler.ignore_links = True
-html2text_handler.ignore_images = True
+def new_html2text_handler() -> html2text.HTML2Text:
+    handler = html2text.HTML2Text()
+    handler.ignore_links = True
+    handler.ignore_images = True
+    return handler
+
+
+html2text_handler = new_html2text_handler()
+# html2text handlers keep parsing state, so each thread gets its own
+_thread_local = threading.local()
+
 
+def _html2text(content: str) -> str:
+    handler = getattr(_thread_local, "html2text_handler", None)
+    if handler is None:
+        handler = _thread_local.html2text_handler = new_html2text_handler()
+    return handler.handle(content)
 
-def html_to_markdown(root: Node):
-    root.content = html2text_handler.handle(root.content)
-    for child in root.children:
-        html_to_markdown(child)
+
+class MarkdownCache:
+    """
+    The markdown of html contents, keyed by the hash of the html, keeping the most recently used ones
+    """
+
+    def __init__(self, max_size=4096):
+        self.max_size = max_size
+        self.items: OrderedDict[bytes, str] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def convert(self, content: str) -> str:
+        key = hashlib.blake2b(content.encode("utf-8"), digest_size=16).digest()
+        with self.lock:
+            markdown = self.items.get(key)
+            if markdown is not None:
+                self.items.move_to_end(key)
+                return markdown
+        markdown = _html2text(content)
+        with self.lock:
+            self.items[key] = markdown
+            if len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+        return markdown
+
+
+markdown_cache = MarkdownCache()
+
+
+def html_to_markdown(root: Node, max_workers=1, cache: MarkdownCache | None = markdown_cache):
+    """
+    Convert the contents in the subtree of `root` from html to markdown.
+    :param max_workers: The number of threads converting the contents
+    :param cache: The cache of converted contents, shared across calls. No caching if None
+    """
+    nodes = list(root.iter_subtree_with_dfs())
+    contents = [node.content for node in nodes]
+    convert = cache.convert if cache is not None else _html2text
+    # Contents repeated in the tree are converted once
+    unique_contents = list(dict.fromkeys(contents))
+    if max_workers > 1 and len(unique_contents) > 1:
+        with ThreadPoolExecutor(max_workers) as executor:
+            markdowns = list(executor.map(convert, unique_contents))
+    else:
+        markdowns = list(map(convert, unique_contents))
+    markdown_of = dict(zip(unique_contents, markdowns))
+    for node, content in zip(nodes, contents):
+        node.content = markdown_of[content]
 
 
 if __name__ == "__main__":
@@ -0,0 +1,210 @@
+from __future__ import annotations
+
+import base64
+import hashlib
+import mimetypes
+import os
+import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Tuple
+
+from fibers.tree import Node
+from fibers.tree.node_attr import Attr
+
+"""
+# Image cache
+
+Inlining images into html reads and encodes every file once per `<img>`.
+`ImageCache` keeps the data url of each file, keyed by its resolved path,
+modification time and size, and stores each distinct image once by its hash,
+so an image used in many nodes is read and encoded once. `load_many` reads the
+files in a thread pool. The data urls are evicted least recently used first
+once they exceed `max_bytes`.
+
+With `ImageStore`, the images are kept once on the root of a tree and the
+`<img>` elements refer to them by hash instead of embedding them. The nodes
+with references get an `ImageRefs`, which puts the data urls back when the
+node is rendered.
+"""
+
+IMAGE_REF_PREFIX = "fibers-image:"
+_image_ref_pattern = re.compile(re.escape(IMAGE_REF_PREFIX) + r"([0-9a-f]{64})")
+
+_magic_numbers = [
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+    (b"BM", "image/bmp"),
+    (b"II*\x00", "image/tiff"),
+    (b"MM\x00*", "image/tiff"),
+    (b"\x00\x00\x01\x00", "image/x-icon"),
+]
+
+
+def sniff_mime(data: bytes, path: str = "") -> str:
+    """
+    :return: The MIME type of the image in `data`, guessed from `path` if the content is not recognized
+    """
+    for magic, mime in _magic_numbers:
+        if data.startswith(magic):
+            return mime
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    if b"<svg" in data[:1024]:
+        return "image/svg+xml"
+    mime, _ = mimetypes.guess_type(path)
+    return mime or "application/octet-stream"
+
+
+class ImageCache:
+    def __init__(self, max_bytes: int | None = None):
+        """
+        :param max_bytes: The total size of the data urls to keep. Unbounded if None
+        """
+        self.max_bytes = max_bytes
+        # (resolved path, mtime, size) -> hash
+        self.digests: Dict[Tuple[str, int, int], str] = {}
+        # hash -> data url, least recently used first
+        self.data_urls: OrderedDict[str, str] = OrderedDict()
+        self.n_bytes = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _key(path: str) -> Tuple[str, int, int]:
+        path = os.path.realpath(path)
+        stat = os.stat(path)
+        return path, stat.st_mtime_ns, stat.st_size
+
+    def get(self, path: str) -> Tuple[str, str]:
+        """
+        :return: The hash and the data url of the image at `path`
+        """
+        key = self._key(path)
+        with self.lock:
+            digest = self.digests.get(key)
+            data_url = self.data_urls.get(digest) if digest is not None else None
+            if data_url is not None:
+                self.data_urls.move_to_end(digest)
+                return digest, data_url
+        with open(key[0], "rb") as f:
+            data = f.read()
+        digest = hashlib.sha256(data).hexdigest()
+        encoded = base64.b64encode(data).decode("utf-8")
+        data_url = f"data:{sniff_mime(data, path)};base64,{encoded}"
+        with self.lock:
+            self.digests[key] = digest
+            if digest not in self.data_urls:
+                self.data_urls[digest] = data_url
+                self.n_bytes += len(data_url)
+                self._evict()
+        return digest, data_url
+
+    def _evict(self):
+        if self.max_bytes is None:
+            return
+        # Keep at least the newest image, even if it is larger than the bound
+        while self.n_bytes > self.max_bytes and len(self.data_urls) > 1:
+            _, data_url = self.data_urls.popitem(last=False)
+            self.n_bytes -= len(data_url)
+
+    def load_many(self, paths: Iterable[str], max_workers=8):
+        """
+        Load the images at `paths` into the cache concurrently
+        """
+        paths = set(paths)
+        if len(paths) <= 1 or max_workers <= 1:
+            for path in paths:
+                self.get(path)
+            return
+        with ThreadPoolExecutor(max_workers) as executor:
+            # Consume the results to raise the errors
+            for _ in executor.map(self.get, paths):
+                pass
+
+
+default_image_cache = ImageCache(max_bytes=64 << 20)
+
+
+class ImageStore(Attr):
+    """
+    The images referred to by hash in the subtree of the node, as `IMAGE_REF_PREFIX + hash`
+    """
+
+    def __init__(self, node: Node):
+        super().__init__(node)
+        self.images: Dict[str, str] = {}
+
+    def add(self, digest: str, data_url: str) -> str:
+        """
+        :return: The src referring to the image
+        """
+        if digest not in self.images:
+            self.images[digest] = data_url
+            self.node.mark_dirty()
+        return IMAGE_REF_PREFIX + digest
+
+    def resolve(self, src: str) -> str:
+        """
+        :return: The data url of `src` if it refers to a stored image, otherwise `src`
+        """
+        if src.startswith(IMAGE_REF_PREFIX):
+            return self.images.get(src[len(IMAGE_REF_PREFIX):], src)
+        return src
+
+    def resolve_html(self, html: str) -> str:
+        """
+        :return: `html` with the references to stored images replaced by their data urls
+        """
+        if IMAGE_REF_PREFIX not in html:
+            return html
+        return _image_ref_pattern.sub(lambda match: self.images.get(match.group(1), match.group(0)), html)
+
+    def fork(self, node):
+        attr = super().fork(node)
+        attr.images = dict(self.images)
+        return attr
+
+    def serialize(self):
+        return {"images": self.images}
+
+    @classmethod
+    def deserialize(cls, node, payload):
+        attr = cls(node)
+        attr.images = dict(payload["images"])
+        return attr
+
+
+def find_image_store(node: Node) -> ImageStore | None:
+    """
+    :return: The `ImageStore` of the closest ancestor of `node` having one
+    """
+    for ancestor in node.path_to_root():
+        store = ancestor.get_attr_or_none(ImageStore)
+        if store is not None:
+            return store
+    return None
+
+
+class ImageRefs(Attr):
+    """
+    Marks a node whose content refers to the images of an `ImageStore` above it.
+    The references are replaced by the data urls in the rendered content
+    """
+
+    def render(self, rendered):
+        content = rendered.tabs.get("content")
+        if not isinstance(content, str):
+            return
+        store = find_image_store(self.node)
+        if store is not None:
+            rendered.tabs["content"] = store.resolve_html(content)
+
+    def serialize(self):
+        return {}
+
+    @classmethod
+    def deserialize(cls, node, payload):
+        return cls(node)
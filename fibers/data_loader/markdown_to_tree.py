@@ -1,19 +1,205 @@
+from __future__ import annotations
+
+import html
+import re
+from typing import Iterator, List, Tuple
+
 import markdown
-from bs4 import BeautifulSoup
+from markdown.util import BLOCK_LEVEL_ELEMENTS
 
-from fibers.data_loader.html_to_tree import html_to_raw_tree, html_to_markdown
+from fibers.data_loader.html_to_tree import SectionBuilder, html_to_raw_tree, parse_html
 from fibers.tree import Node
 
 
-def markdown_to_tree(src: str, title="", keep_markdown=False) -> Node:
+def markdown_to_tree(src: str, title="", keep_markdown=False, parser: str = None) -> Node:
+    """
+    :param keep_markdown: Keep the markdown source of each block as the content.
+    The tree is then built from the markdown directly, without going through html
+    """
+    if keep_markdown:
+        return markdown_sections_to_tree(src, title)
     html = markdown.markdown(src)
-    soup = BeautifulSoup(html, "html.parser")
+    soup = parse_html(html, parser)
     root = html_to_raw_tree(soup, title=title)
-    if keep_markdown:
-        html_to_markdown(root)
     return root
 
 
+"""
+## Native section splitting
+
+The markdown is split into blocks at blank lines. Fenced code blocks and raw
+html blocks are kept whole, and the items of a list stay in one block as in the
+html of the list. As in Python-Markdown, a raw html block starts with a
+block-level tag or a comment at the start of a line, and goes on until the tag
+is closed.
+"""
+
+_atx_heading_pattern = re.compile(r"^ {0,3}(#{1,6})(?:[ \t]+(.*?))?(?:[ \t]+#+)?[ \t]*$")
+_setext_underline_pattern = re.compile(r"^ {0,3}(=+|-+)[ \t]*$")
+_fence_pattern = re.compile(r"^ {0,3}(`{3,}|~{3,})")
+_list_item_pattern = re.compile(r"^ {0,3}([*+-]|\d{1,9}[.)])[ \t]")
+_blockquote_pattern = re.compile(r"^ {0,3}>")
+_html_block_pattern = re.compile(r"^ {0,3}<(!--|[a-zA-Z][a-zA-Z0-9]*)(?=[\s/>]|$)")
+_void_elements = {"hr"}
+
+
+class _HtmlBlock:
+    """
+    The nesting of the tag opening a raw html block, to find where the block ends
+    """
+
+    def __init__(self, tag: str):
+        if tag == "!--":
+            self.open_pattern = None
+            self.close_pattern = re.compile(r"-->")
+        else:
+            self.open_pattern = re.compile(rf"<{tag}(?=[\s/>]|$)", re.IGNORECASE)
+            self.close_pattern = re.compile(rf"</{tag}\s*>", re.IGNORECASE)
+        # Void elements are blocks of one line
+        self.void = tag in _void_elements
+        self.depth = 0
+
+    @staticmethod
+    def start(line: str) -> _HtmlBlock | None:
+        match = _html_block_pattern.match(line)
+        if match is None:
+            return None
+        tag = match.group(1).lower()
+        if tag != "!--" and tag not in BLOCK_LEVEL_ELEMENTS:
+            return None
+        return _HtmlBlock(tag)
+
+    def feed(self, line: str) -> bool:
+        """
+        :return: Whether the block ends with `line`
+        """
+        if self.void:
+            return True
+        if self.open_pattern is None:
+            return self.close_pattern.search(line) is not None
+        self.depth += len(self.open_pattern.findall(line)) - len(self.close_pattern.findall(line))
+        return self.depth <= 0
+
+_inline_patterns = [
+    # Links and images keep their text
+    (re.compile(r"!?\[([^\]]*)\]\([^)]*\)"), r"\1"),
+    (re.compile(r"`([^`]*)`"), r"\1"),
+    (re.compile(r"(\*\*|\*)(\S(?:.*?\S)?)\1"), r"\2"),
+    (re.compile(r"(?<!\w)(__|_)(\S(?:.*?\S)?)\1(?!\w)"), r"\2"),
+    (re.compile(r"\\([\\`*_{}\[\]()#+\-.!])"), r"\1"),
+]
+
+
+def heading_text(source: str) -> str:
+    """
+    :return: The plain text of a heading, without its inline markup
+    """
+    for pattern, replacement in _inline_patterns:
+        source = pattern.sub(replacement, source)
+    return html.unescape(source).strip()
+
+
+def iter_markdown_blocks(src: str) -> Iterator[Tuple[int, str]]:
+    """
+    Split `src` into headings and blocks.
+    :return: An iterator of (level, text). The level is 1-6 for headings with their text,
+    and 0 for blocks with their markdown source
+    """
+    block: List[str] = []
+    # The fence closing the code block being read
+    fence = None
+    # The raw html block being read
+    html_block: _HtmlBlock | None = None
+    # Whether the block is a list, which continues after blank lines while the items go on
+    in_list = False
+    # Whether the block is a paragraph, the only block a setext underline turns into a heading
+    paragraph = True
+    pending_blank = False
+
+    def flush():
+        nonlocal in_list, paragraph
+        text = "\n".join(block).strip("\n")
+        block.clear()
+        in_list = False
+        paragraph = True
+        return text
+
+    for line in src.splitlines():
+        if fence is not None:
+            block.append(line)
+            stripped = line.strip()
+            if stripped.startswith(fence) and stripped.strip(fence[0]) == "":
+                fence = None
+            continue
+        if html_block is not None:
+            block.append(line)
+            if html_block.feed(line):
+                html_block = None
+                yield 0, flush()
+            continue
+        if len(line.strip()) == 0:
+            if len(block) > 0:
+                pending_blank = True
+                if in_list:
+                    block.append(line)
+                else:
+                    yield 0, flush()
+            continue
+        if pending_blank and in_list and not (_list_item_pattern.match(line) or line[:1] in (" ", "\t")):
+            yield 0, flush()
+        pending_blank = False
+        if not in_list:
+            html_block = _HtmlBlock.start(line)
+            if html_block is not None:
+                if len(block) > 0:
+                    yield 0, flush()
+                block.append(line)
+                if html_block.feed(line):
+                    html_block = None
+                    yield 0, flush()
+                continue
+        match = _atx_heading_pattern.match(line)
+        if match is not None:
+            if len(block) > 0:
+                yield 0, flush()
+            yield len(match.group(1)), heading_text(match.group(2) or "")
+            continue
+        match = _setext_underline_pattern.match(line)
+        if match is not None and len(block) > 0 and paragraph and not in_list:
+            text = " ".join(block_line.strip() for block_line in block)
+            block.clear()
+            yield (1 if match.group(1)[0] == "=" else 2), heading_text(text)
+            continue
+        fence_match = _fence_pattern.match(line)
+        if fence_match is not None:
+            fence = fence_match.group(1)
+            paragraph = False
+        elif len(block) == 0 and _list_item_pattern.match(line):
+            in_list = True
+        elif _blockquote_pattern.match(line) or (len(block) == 0 and line.startswith(("    ", "\t"))):
+            # Blockquotes and indented code
+            paragraph = False
+        block.append(line)
+    if len(block) > 0:
+        text = flush()
+        if len(text.strip()) > 0:
+            yield 0, text
+
+
+def markdown_sections_to_tree(src: str, title="") -> Node:
+    """
+    Build the tree of `markdown_to_tree` from the headings of `src`, keeping the markdown source
+    of each block as its content
+    """
+    builder = SectionBuilder(title)
+    for level, text in iter_markdown_blocks(src):
+        if level == 0:
+            builder.add_text(text)
+        else:
+            builder.add_heading(level, text)
+    return builder.root
+
+
 if __name__ == "__main__":
     from fibers.testing.testing_trees.loader import load_sample_src
 
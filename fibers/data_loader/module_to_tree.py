@@ -2,7 +2,7 @@ from __future__ import annotations
 
 import inspect
 
-from fibers.tree.node_attr.code import set_code_obj
+from fibers.tree.node_attr.code import set_code_obj, warm_source_cache
 
 try:
     from moduler.core import build_module_tree
@@ -28,6 +28,8 @@ def get_tree_for_module(module) -> Node:
     module_name = module.__name__
     root = Node(module_name)
     add_module_tree_to_node(module, root)
+    # Read the sources now, so that rendering the tree does not read files
+    warm_source_cache(root)
     return root
 
 
@@ -58,6 +60,7 @@ def build_tree_for_struct(curr_struct: Struct, root_note: Node) -> Node:
             example_node.get_attr(
                 CodeData).obj = example_function_node.get_attr(
                 CodeData).obj
+            example_node.mark_dirty()
             example_function_node.remove_self()
         elif child_struct.struct_type == "document":
             markdown_src = child_struct.obj
@@ -1,9 +1,61 @@
 from __future__ import annotations
 
-from typing import TYPE_CHECKING
+import io
+import json
+import weakref
+from collections import deque
+from typing import IO, TYPE_CHECKING, Dict, Iterable, Set, Tuple
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 if TYPE_CHECKING:
     from fibers.tree import Node
+    from fibers.tree.node_attr.base import MessageResult
+
+
+def dumps_json(obj, backend: str = None) -> bytes:
+    """
+    :param backend: "orjson" or "json". orjson if it is installed when None
+    :return: The json of `obj` encoded in utf-8
+    """
+    if backend is None:
+        backend = "orjson" if orjson is not None else "json"
+    if backend == "orjson":
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            # e.g. integers beyond 64 bits, which the json module supports
+            pass
+    elif backend != "json":
+        raise ValueError(f"Unknown json backend: {backend}")
+    return json.dumps(obj, ensure_ascii=False).encode("utf-8")
+
+
+def _copy_json(value):
+    if value.__class__ is dict:
+        return {key: _copy_json(item) for key, item in value.items()}
+    if value.__class__ is list:
+        return [_copy_json(item) for item in value]
+    return value
+
+
+def _copy_node_json(node_json: dict) -> dict:
+    """
+    :return: A deep copy of the json of a node, faster than `copy.deepcopy`
+    """
+    copy = node_json.copy()
+    copy["children"] = node_json["children"].copy()
+    copy["other_parents"] = node_json["other_parents"].copy()
+    # Most tabs are strings, and most nodes have no data or tools
+    copy["tabs"] = {key: tab if tab.__class__ is str else _copy_json(tab)
+                    for key, tab in node_json["tabs"].items()}
+    data = node_json["data"]
+    copy["data"] = _copy_json(data) if len(data) > 0 else {}
+    copy["tools"] = [_copy_json(tool) if len(tool) > 0 else {} for tool in node_json["tools"]]
+    return copy
 
 
 class Rendered:
@@ -16,18 +68,33 @@ class Rendered:
         self.data = {}
 
     def to_json(self, node_dict):
-        if self.node.node_id in node_dict:
+        """
+        Add the json of the rendered subtree to `node_dict`, children before parents
+        """
+        if str(self.node.node_id) in node_dict:
             return
-        node_json = self.to_json_without_children()
-        # Add children
-        for child in self.children:
-            child.to_json(node_dict)
-        node_dict[str(self.node.node_id)] = node_json
+        stack = [(self, iter(self.children))]
+        # The nodes on the stack, which are not in `node_dict` yet
+        on_stack = {str(self.node.node_id)}
+        while len(stack) > 0:
+            rendered, children = stack[-1]
+            for child in children:
+                child_id = str(child.node.node_id)
+                if child_id not in node_dict and child_id not in on_stack:
+                    stack.append((child, iter(child.children)))
+                    on_stack.add(child_id)
+                    break
+            else:
+                stack.pop()
+                node_dict[str(rendered.node.node_id)] = rendered.to_json_without_children()
 
-    def to_json_without_children(self) -> dict:
+    def to_json_without_children(self, children: Iterable[Node] = None) -> dict:
+        """
+        :param children: The children to list in the json. All the children of the node if None
+        """
         children_ids = []
-        for child in self.children:
-            children_ids.append(str(child.node.node_id))
+        for child in (self.node.children if children is None else children):
+            children_ids.append(str(child.node_id))
         parent_id = str(self.node._parent.node_id) if self.node._parent else None
         node_json = {
             "title": self.title,
@@ -43,26 +110,245 @@ class Rendered:
 
 
 class Renderer:
+    """
+    Renders trees to the json of the GUI.
+
+    The json of each node is cached with the node and its version, which increases
+    whenever the node changes, so only the changed nodes are rendered again.
+    The versions count per node object, so the cache also checks that it is the same object:
+    a tree read again from a file has the same ids and versions as before.
+    Attrs may depend on other nodes without changing their own node; pass the nodes
+    to re-render with `invalidate` or `apply_message_result`.
+    `render_patch` outputs only the nodes that changed since its last call.
+    `render_view` and `render_children` output only the nodes the client shows.
+    `write_json` streams the json of a tree to a file without building it in memory.
+    The json output by the renderer is a copy of the cache, so callers can change it.
+    """
+
     def __init__(self):
-        pass
+        # node id -> (weak reference to the node, version, json)
+        self.cache: Dict[int, Tuple[weakref.ref, int, dict]] = {}
+        # The ids of the nodes to render again regardless of their version
+        self.invalidated: Set[int] = set()
+        # node id -> (node, version) of the nodes output by the last `render_patch`
+        self.sent_versions: Dict[int, Tuple[Node, int]] = {}
 
     def node_handler(self, node: Node, rendered: Rendered):
-        for attr_class, attr_value in node.attrs.items():
+        for attr_class, attr_value in node.read_attrs().items():
             attr_value.render(rendered)
 
-    def render(self, node: Node) -> Rendered:
+    def render_node(self, node: Node) -> Rendered:
+        """
+        Render `node` without its children
+        """
         rendered = Rendered(node)
         rendered.title = node.title
         rendered.tabs["content"] = node.content
         self.node_handler(node, rendered)
-        for child in node.children:
-            rendered.children.append(self.render(child))
         return rendered
 
+    def render(self, node: Node) -> Rendered:
+        root = self.render_node(node)
+        stack = [root]
+        while len(stack) > 0:
+            rendered = stack.pop()
+            for child in rendered.node.children:
+                rendered_child = self.render_node(child)
+                rendered.children.append(rendered_child)
+                stack.append(rendered_child)
+        return root
+
+    def node_json(self, node: Node) -> dict:
+        """
+        :return: The json of `node`, from the cache if it did not change
+        """
+        return _copy_node_json(self._node_json(node))
+
+    def _node_json(self, node: Node) -> dict:
+        """
+        :return: The json of `node` held in the cache. Do not change it
+        """
+        cached = self._cached_json(node)
+        if cached is not None:
+            return cached
+        node_id = node.node_id
+        # Nodes without versions (e.g. in compact trees) are never cached
+        version = getattr(node, "version", None)
+        node_json = self.render_node(node).to_json_without_children()
+        if version is not None:
+            self.cache[node_id] = (weakref.ref(node), version, node_json)
+        self.invalidated.discard(node_id)
+        return node_json
+
+    def invalidate(self, nodes: Iterable[Node]):
+        """
+        Render `nodes` again at the next render, even if they did not change
+        """
+        for node in nodes:
+            self.invalidated.add(node.node_id)
+
+    def apply_message_result(self, result: MessageResult):
+        self.invalidate(result.node_to_re_render)
+
     def render_to_json(self, node: Node):
         node_dict = {}
-        self.render(node).to_json(node_dict)
+        # Children before parents, as `Rendered.to_json` outputs them
+        for sub_node in node.iter_subtree_with_dfs():
+            node_dict[str(sub_node.node_id)] = self.node_json(sub_node)
         return {
             "metadata": {"rootId": str(node.node_id)},
             "nodeDict": node_dict,
         }
+
+    def render_patch(self, node: Node):
+        """
+        :return: The nodes added and changed in the subtree of `node` since the last call, and the ids
+        of the nodes removed from it. The first call outputs the whole subtree as added
+        """
+        added = {}
+        changed = {}
+        sent_versions = {}
+        for sub_node in node.iter_subtree_with_dfs():
+            node_id = sub_node.node_id
+            version = getattr(sub_node, "version", None)
+            sent_versions[node_id] = (sub_node, version)
+            sent = self.sent_versions.get(node_id)
+            if sent is None:
+                added[str(node_id)] = self.node_json(sub_node)
+            elif version is None or sent[0] is not sub_node or version != sent[1] or node_id in self.invalidated:
+                changed[str(node_id)] = self.node_json(sub_node)
+        removed = [node_id for node_id in self.sent_versions if node_id not in sent_versions]
+        for node_id in removed:
+            self.cache.pop(node_id, None)
+        self.sent_versions = sent_versions
+        return {
+            "metadata": {"rootId": str(node.node_id)},
+            "added": added,
+            "changed": changed,
+            "removed": [str(node_id) for node_id in removed],
+        }
+
+    def write_json(self, node: Node, out: IO, backend: str = None, buffer_size=1 << 16,
+                   use_cache=False):
+        """
+        Write the json of `render_to_json(node)` to `out`, one node at a time.
+        Only the json of one node and the write buffer are kept in memory.
+        :param out: A file or socket file opened in binary or text mode
+        :param backend: The json backend of `dumps_json`
+        :param buffer_size: The number of bytes buffered before writing to `out`
+        :param use_cache: Add the json of the nodes to the cache of the renderer, which then grows with the tree.
+        The json of cached nodes that did not change is used either way
+        """
+        text_mode = isinstance(out, io.TextIOBase)
+        buffer = bytearray()
+
+        def write(data: bytes):
+            buffer.extend(data)
+            if len(buffer) >= buffer_size:
+                flush()
+
+        def flush():
+            if len(buffer) > 0:
+                out.write(buffer.decode("utf-8") if text_mode else bytes(buffer))
+                buffer.clear()
+
+        write(b'{"metadata":' + dumps_json({"rootId": str(node.node_id)}, backend) + b',"nodeDict":{')
+        first = True
+        # Children before parents, as `Rendered.to_json` outputs them. `walk` outputs shared nodes once
+        for sub_node in node.iter_subtree_with_dfs():
+            if use_cache:
+                node_json = self._node_json(sub_node)
+            else:
+                node_json = self._cached_json(sub_node)
+                if node_json is None:
+                    node_json = self.render_node(sub_node).to_json_without_children()
+            if not first:
+                write(b",")
+            first = False
+            write(dumps_json(str(sub_node.node_id), backend) + b":" + dumps_json(node_json, backend))
+        write(b"}}")
+        flush()
+
+    def _cached_json(self, node: Node) -> dict | None:
+        """
+        :return: The cached json of `node` if it did not change, otherwise None. Do not change it
+        """
+        cached = self.cache.get(node.node_id)
+        if cached is not None and cached[0]() is node and cached[1] == getattr(node, "version", None) \
+                and node.node_id not in self.invalidated:
+            return cached[2]
+        return None
+
+    """
+    ## Lazy rendering
+
+    `render_view` outputs only the first levels of a tree, so its cost does not grow with the
+    size of the tree. The json of each output node has two more keys:
+    - `childCount`: The number of children of the node
+    - `childOffset`: The index of the first child in `children`
+
+    `children` holds one page of at most `page_size` children. The children not in `nodeDict`
+    are stubs, to fetch with `render_children` when the client expands them or pages through
+    the siblings.
+    """
+
+    def render_view(self, node: Node, depth=2, page_size=100):
+        """
+        :param depth: The number of levels below `node` to output
+        :param page_size: The maximum number of children output for each node
+        :return: The json of `node` and of the first page of its descendants down to `depth`
+        """
+        node_dict = {}
+        self._render_pages(node, 0, depth, page_size, node_dict)
+        return {
+            "metadata": {"rootId": str(node.node_id)},
+            "nodeDict": node_dict,
+        }
+
+    def render_children(self, node: Node, offset=0, depth=1, page_size=100):
+        """
+        :param offset: The index of the first child of the page
+        :param depth: The number of levels below `node` to output. 1 outputs only the children
+        :return: The json of `node` with the children from `offset`, and of these children
+        and their descendants down to `depth`
+        """
+        node_dict = {}
+        self._render_pages(node, offset, depth, page_size, node_dict)
+        return {
+            "metadata": {"rootId": str(node.node_id), "offset": offset},
+            "nodeDict": node_dict,
+        }
+
+    def _render_pages(self, node: Node, offset: int, depth: int, page_size: int, node_dict: dict):
+        # Breadth first, so that nodes with several parents get the depth of their closest parent
+        queue = deque([(node, offset, 0)])
+        while len(queue) > 0:
+            sub_node, offset, level = queue.popleft()
+            node_id = str(sub_node.node_id)
+            if node_id in node_dict:
+                continue
+            children = sub_node.children
+            # Index the page instead of slicing, which would copy all the children
+            page = [children[i] for i in range(offset, min(offset + page_size, len(children)))]
+            node_dict[node_id] = self.page_json(sub_node, page, offset)
+            if level < depth:
+                for child in page:
+                    queue.append((child, 0, level + 1))
+
+    def page_json(self, node: Node, page: list, offset: int) -> dict:
+        """
+        :return: The json of `node` listing only the children in `page`, which start at `offset`
+        """
+        n_children = len(node.children)
+        if len(page) == n_children:
+            node_json = self.node_json(node)
+        else:
+            # Avoid listing all the children of large nodes
+            cached = self._cached_json(node)
+            if cached is not None:
+                node_json = _copy_node_json(dict(cached, children=[str(child.node_id) for child in page]))
+            else:
+                node_json = self.render_node(node).to_json_without_children(page)
+        node_json["childCount"] = n_children
+        node_json["childOffset"] = offset
+        return node_json
@@ -0,0 +1,372 @@
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import inspect
+import json
+import time
+from collections import deque
+from http import HTTPStatus
+from typing import TYPE_CHECKING, Deque, Dict, List, Set, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+from fibers.gui.renderer import Renderer, dumps_json
+from fibers.tree.node_attr.base import MessageResult
+
+if TYPE_CHECKING:
+    from fibers.tree import Node
+
+"""
+# Render service
+
+`RenderService` runs the interactive loop of the GUI on asyncio. Each incoming
+message is handled by the `handle_message` of the attrs of its node, which may
+be coroutines. Messages to different nodes are handled concurrently, and the
+messages to one node wait for each other with a per-node lock.
+
+The `MessageResult`s scope the updates: only the nodes passed to `rerender`
+are rendered again, and `select` sets the selected node. The results are
+collected for `coalesce_delay` seconds after the first message of a burst, then
+one update is pushed to every connected client.
+
+Clients connect with `connect()`, which returns a `Client` that receives the
+events. `serve_sse` exposes the service over http with server-sent events, and
+`LocalClient` drives it in-process without any network.
+
+The events are dicts:
+- `{"type": "init", "metadata": ..., "nodeDict": ...}`: The first levels of the tree, as `Renderer.render_view`
+- `{"type": "update", "nodeDict": ..., "selected": ..., "messageIds": ...}`: The nodes rendered again,
+with the first page of their children as in the init events
+
+`stats` records the latency of each message, from its arrival to the push of its update.
+"""
+
+
+class LatencyStats:
+    """
+    The latest samples of each measured stage, in seconds
+    """
+
+    def __init__(self, max_samples=10000):
+        self.max_samples = max_samples
+        self.samples: Dict[str, Deque[float]] = {}
+
+    def record(self, name: str, seconds: float):
+        samples = self.samples.get(name)
+        if samples is None:
+            samples = self.samples[name] = deque(maxlen=self.max_samples)
+        samples.append(seconds)
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        """
+        :return: The count, and the mean, p50, p95 and max in milliseconds of each stage
+        """
+        summary = {}
+        for name, samples in self.samples.items():
+            if len(samples) == 0:
+                continue
+            ordered = sorted(samples)
+            summary[name] = {
+                "count": len(ordered),
+                "mean": sum(ordered) / len(ordered) * 1000,
+                "p50": ordered[len(ordered) // 2] * 1000,
+                "p95": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000,
+                "max": ordered[-1] * 1000,
+            }
+        return summary
+
+
+class Client:
+    """
+    A connection to the service. The events pushed to it are read with `receive`
+    """
+
+    def __init__(self):
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.closed = False
+
+    def push(self, event: dict | None):
+        if not self.closed:
+            self.queue.put_nowait(event)
+
+    async def receive(self) -> dict | None:
+        """
+        :return: The next event, or None when the service closed the connection
+        """
+        return await self.queue.get()
+
+
+class RenderService:
+    def __init__(self, root: Node, renderer: Renderer = None, coalesce_delay=0.01, view_depth=2,
+                 page_size=100):
+        """
+        :param coalesce_delay: The seconds to collect the results of messages before pushing an update
+        :param view_depth: The number of levels of the tree sent to new clients
+        :param page_size: The maximum number of children sent for each node
+        """
+        self.root = root
+        self.renderer = renderer if renderer is not None else Renderer()
+        self.coalesce_delay = coalesce_delay
+        self.view_depth = view_depth
+        self.page_size = page_size
+        self.clients: Set[Client] = set()
+        # node id -> (lock, number of tasks holding or waiting for it)
+        self.node_locks: Dict[int, Tuple[asyncio.Lock, int]] = {}
+        # The results waiting for the next update
+        self.pending_nodes: Dict[int, Node] = {}
+        self.pending_selection: Node | None = None
+        self.pending_messages: List[Tuple[str | None, float]] = []
+        self.flush_task: asyncio.Task | None = None
+        self.stats = LatencyStats()
+        # str node id -> node, rebuilt when a node is not found
+        self.node_index: Dict[str, Node] = {}
+
+    """
+    ## Clients
+    """
+
+    def connect(self) -> Client:
+        client = Client()
+        self.clients.add(client)
+        view = self.renderer.render_view(self.root, self.view_depth, self.page_size)
+        client.push({"type": "init", **view})
+        return client
+
+    def disconnect(self, client: Client):
+        self.clients.discard(client)
+        client.closed = True
+
+    def render_children(self, node_id: str, offset=0, depth=1) -> dict:
+        """
+        Fetch a page of the children of a node, for the stubs of the views
+        """
+        return self.renderer.render_children(self.find_node(node_id), offset, depth, self.page_size)
+
+    """
+    ## Messages
+    """
+
+    def find_node(self, node_id: str) -> Node:
+        node = self.node_index.get(node_id)
+        if node is None:
+            self.node_index = {str(node.node_id): node for node in self.root.iter_subtree_with_bfs()}
+            node = self.node_index.get(node_id)
+            if node is None:
+                raise KeyError(f"Node {node_id} is not in the tree")
+        return node
+
+    @contextlib.asynccontextmanager
+    async def _node_lock(self, node_id: int):
+        lock, n_users = self.node_locks.get(node_id, (None, 0))
+        if lock is None:
+            lock = asyncio.Lock()
+        self.node_locks[node_id] = (lock, n_users + 1)
+        try:
+            async with lock:
+                yield
+        finally:
+            lock, n_users = self.node_locks[node_id]
+            if n_users == 1:
+                del self.node_locks[node_id]
+            else:
+                self.node_locks[node_id] = (lock, n_users - 1)
+
+    async def handle(self, message: dict) -> MessageResult:
+        """
+        Pass `message` to the attrs of its node and schedule the update of its result.
+        :param message: A dict with the `node_id` of the target node. With an `attr`, only the attr with
+        this class name handles it. An `id` is echoed in the `messageIds` of the update
+        :return: The merged results of the attrs
+        """
+        received = time.perf_counter()
+        node = self.find_node(str(message["node_id"]))
+        attr_name = message.get("attr")
+        result = MessageResult()
+        async with self._node_lock(node.node_id):
+            locked = time.perf_counter()
+            self.stats.record("lock_wait", locked - received)
+            for attr_class, attr in list(node.attrs.items()):
+                if attr_name is not None and attr_class.__name__ != attr_name:
+                    continue
+                attr_result = attr.handle_message(message)
+                if inspect.isawaitable(attr_result):
+                    attr_result = await attr_result
+                if attr_result is None:
+                    continue
+                result.node_to_re_render |= attr_result.node_to_re_render
+                if attr_result.new_selected_node is not None:
+                    result.new_selected_node = attr_result.new_selected_node
+            self.stats.record("handle", time.perf_counter() - locked)
+        self._schedule(result, message.get("id"), received)
+        return result
+
+    def _schedule(self, result: MessageResult, message_id: str | None, received: float):
+        for node in result.node_to_re_render:
+            self.pending_nodes[node.node_id] = node
+        if result.new_selected_node is not None:
+            self.pending_selection = result.new_selected_node
+        self.pending_messages.append((message_id, received))
+        if self.flush_task is None or self.flush_task.done():
+            self.flush_task = asyncio.get_running_loop().create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.coalesce_delay)
+        self.flush()
+
+    def flush(self):
+        """
+        Push the update of the pending results to the clients
+        """
+        nodes = list(self.pending_nodes.values())
+        selection = self.pending_selection
+        messages = self.pending_messages
+        self.pending_nodes = {}
+        self.pending_selection = None
+        self.pending_messages = []
+        if len(messages) == 0:
+            return
+        start = time.perf_counter()
+        # The results come from the attrs, which may depend on other nodes, so the nodes
+        # are rendered again even if they did not change
+        self.renderer.invalidate(nodes)
+        node_dict = {}
+        for node in nodes:
+            children = node.children
+            # The first page, in the format of the init events and `render_children`
+            page = [children[i] for i in range(min(self.page_size, len(children)))]
+            node_dict[str(node.node_id)] = self.renderer.page_json(node, page, 0)
+        if len(node_dict) > 0 or selection is not None:
+            event = {
+                "type": "update",
+                "nodeDict": node_dict,
+                "selected": str(selection.node_id) if selection is not None else None,
+                "messageIds": [message_id for message_id, _ in messages if message_id is not None],
+            }
+            for client in list(self.clients):
+                client.push(event)
+        pushed = time.perf_counter()
+        self.stats.record("render", pushed - start)
+        for _, received in messages:
+            self.stats.record("total", pushed - received)
+
+    async def close(self):
+        """
+        Push the pending update and disconnect the clients
+        """
+        if self.flush_task is not None and not self.flush_task.done():
+            self.flush_task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self.flush_task
+        self.flush()
+        for client in list(self.clients):
+            client.push(None)
+            self.disconnect(client)
+
+
+class LocalClient:
+    """
+    An in-process stand-in for the GUI, talking to the service without any network.
+
+    async with LocalClient(service) as client:
+        init = await client.receive()
+        await client.send({"node_id": ..., "id": "1"})
+        update = await client.receive()
+    """
+
+    def __init__(self, service: RenderService):
+        self.service = service
+        self.client: Client | None = None
+
+    async def __aenter__(self):
+        self.client = self.service.connect()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.service.disconnect(self.client)
+
+    async def send(self, message: dict) -> MessageResult:
+        return await self.service.handle(message)
+
+    async def receive(self, timeout: float = None) -> dict | None:
+        return await asyncio.wait_for(self.client.receive(), timeout)
+
+
+"""
+## Server-sent events
+
+- `GET /events`: The stream of events, each as `event: <type>` and `data: <json>`
+- `POST /message`: Handle the json message in the body
+- `GET /children?id=<node id>&offset=<offset>&depth=<depth>`: A page of children, as `render_children`
+"""
+
+
+async def serve_sse(service: RenderService, host="127.0.0.1", port=0) -> asyncio.Server:
+    """
+    Serve `service` over http. The port is chosen by the system if 0, read it from
+    `server.sockets[0].getsockname()`
+    :return: The started server. Close it with `server.close()`
+    """
+
+    async def handle_connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = (await reader.readline()).decode("latin-1").split()
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode("latin-1").strip()
+                if len(line) == 0:
+                    break
+                name, _, value = line.partition(":")
+                headers[name.strip().lower()] = value.strip()
+            if len(request_line) < 2:
+                return
+            method, target = request_line[0], urlsplit(request_line[1])
+            if method == "GET" and target.path == "/events":
+                await _stream_events(service, writer)
+            elif method == "POST" and target.path == "/message":
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                try:
+                    result = await service.handle(json.loads(body))
+                except (KeyError, ValueError) as e:
+                    _write_response(writer, 400, {"error": str(e)})
+                else:
+                    _write_response(writer, 200, {"rerendered": len(result.node_to_re_render)})
+            elif method == "GET" and target.path == "/children":
+                query = {key: values[0] for key, values in parse_qs(target.query).items()}
+                try:
+                    page = service.render_children(query["id"], int(query.get("offset", 0)),
+                                                   int(query.get("depth", 1)))
+                except (KeyError, ValueError) as e:
+                    _write_response(writer, 400, {"error": str(e)})
+                else:
+                    _write_response(writer, 200, page)
+            else:
+                _write_response(writer, 404, {"error": "Not found"})
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle_connection, host, port)
+
+
+def _write_response(writer: asyncio.StreamWriter, status: int, payload: dict):
+    body = dumps_json(payload)
+    writer.write(f"HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\n"
+                 f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n"
+                 f"Connection: close\r\n\r\n".encode("latin-1") + body)
+
+
+async def _stream_events(service: RenderService, writer: asyncio.StreamWriter):
+    writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\n"
+                 b"Connection: keep-alive\r\n\r\n")
+    client = service.connect()
+    try:
+        while True:
+            event = await client.receive()
+            if event is None:
+                break
+            writer.write(b"event: " + event["type"].encode("utf-8") + b"\ndata: " + dumps_json(event) + b"\n\n")
+            await writer.drain()
+    finally:
+        service.disconnect(client)
@@ -0,0 +1,117 @@
+from __future__ import annotations
+
+from typing import TYPE_CHECKING, Tuple
+
+if TYPE_CHECKING:
+    from fibers.tree import Node
+
+"""
+# Ancestry index
+
+Answers root, depth, is-ancestor and lowest-common-ancestor queries along the
+primary parents (`node.parent()`) without walking to the root every time.
+
+When `Node.ancestry_index` is on, each queried node caches an entry
+`(depth, root, jump, parent)` in its `_ancestry` slot. `jump` is a jump pointer
+(Myers, 1983): following jump pointers and parents reaches any ancestor in
+O(log depth) steps. An entry is only cached once the entry of its parent is, so
+when the primary parent of a node changes, clearing the cached entries below it
+stops at the first uncached node.
+"""
+
+Entry = Tuple[int, "Node", "Node", "Node"]
+
+
+def enable_ancestry_index(enabled=True):
+    from fibers.tree import Node
+    Node.ancestry_index = enabled
+
+
+def entry(node: Node) -> Entry:
+    """
+    :return: The cached (depth, root, jump, parent) of `node`, computing the missing entries on the way
+    """
+    if node._ancestry is not None:
+        return node._ancestry
+    # Go up to the first node with an entry
+    path = []
+    while node is not None and node._ancestry is None:
+        path.append(node)
+        node = node._parent
+    for node in reversed(path):
+        parent = node._parent
+        if parent is None:
+            node._ancestry = (0, node, node, None)
+            continue
+        depth, root, jump, _ = parent._ancestry
+        jump_depth, _, jump_jump, _ = jump._ancestry
+        if depth - jump_depth == jump_depth - jump_jump._ancestry[0]:
+            jump = jump_jump
+        else:
+            jump = parent
+        node._ancestry = (depth + 1, root, jump, parent)
+    return path[0]._ancestry
+
+
+def invalidate(node: Node):
+    """
+    Clear the cached entries of `node` and of the nodes under it through their primary parents.
+    """
+    stack = [node]
+    while len(stack) > 0:
+        node = stack.pop()
+        if node._ancestry is None:
+            continue
+        node._ancestry = None
+        for child in node._child_list or ():
+            if child._ancestry is not None and child._ancestry[3] is node:
+                stack.append(child)
+
+
+def level_ancestor(node: Node, depth: int) -> Node:
+    """
+    :return: The ancestor of `node` at `depth`
+    """
+    node_depth, _, jump, parent = entry(node)
+    assert 0 <= depth <= node_depth
+    while node_depth > depth:
+        jump_depth = jump._ancestry[0]
+        if jump_depth >= depth:
+            node = jump
+        else:
+            node = parent
+        node_depth, _, jump, parent = node._ancestry
+    return node
+
+
+def is_ancestor(ancestor: Node, node: Node) -> bool:
+    """
+    :return: Whether `ancestor` is `node` or one of its ancestors along the primary parents
+    """
+    depth = entry(ancestor)[0]
+    if entry(node)[0] < depth:
+        return False
+    return level_ancestor(node, depth) is ancestor
+
+
+def lowest_common_ancestor(a: Node, b: Node) -> Node | None:
+    """
+    :return: The deepest node that is an ancestor of both, or None if they are in different trees
+    """
+    depth_a, root_a, _, _ = entry(a)
+    depth_b, root_b, _, _ = entry(b)
+    if root_a is not root_b:
+        return None
+    if depth_a > depth_b:
+        a = level_ancestor(a, depth_b)
+    elif depth_b > depth_a:
+        b = level_ancestor(b, depth_a)
+    while a is not b:
+        # Nodes at the same depth have jump pointers at the same depth
+        _, _, jump_a, parent_a = a._ancestry
+        _, _, jump_b, parent_b = b._ancestry
+        if jump_a is not jump_b:
+            a, b = jump_a, jump_b
+        else:
+            a, b = parent_a, parent_b
+    return a
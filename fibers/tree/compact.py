@@ -0,0 +1,521 @@
+from __future__ import annotations
+
+from array import array
+from collections.abc import MutableMapping
+from typing import TYPE_CHECKING, Callable, Dict, List, Mapping, Tuple, Type, Iterator
+
+from fibers.tree import loops
+from fibers.tree.node import Node
+from fibers.tree.node_id import COUNTER_BITS, random_namespace
+from fibers.tree.traversal import walk, Order
+
+if TYPE_CHECKING:
+    from fibers.tree.node_attr import Attr
+
+"""
+# Compact tree store
+
+`CompactTree` keeps a whole tree in a few flat arrays instead of one Python
+object per node. Nodes are integer indices, titles and contents live in
+interned string tables, and the children/parents of each node are stored
+in CSR style (an offsets array plus a targets array).
+
+`CompactNode` is a `__slots__` view over one index of the store. It supports
+the part of the `Node` API used to build, walk, render and save trees: the
+data and attrs of the node, `children`/`parents`, `add_child` and the other
+edits, the subtree iterators (and so `fibers.tree.traversal.walk`),
+`find_loop(s)` and `save_sub_tree`. It has no ancestry index, journaling or
+copying; convert the tree with `CompactTree.to_node` for those.
+
+Edits after the last `compact()` go to small per-node overflow lists, which
+are folded back into the CSR arrays by the next `compact()`. The store of a
+view is `view.tree`, so `view.tree.compact()` folds the edits in.
+"""
+
+
+def _fork_attrs(attrs: Mapping[Type[Attr], Attr], owner) -> Dict[Type[Attr], Attr]:
+    return {attr_class: attr.fork(owner) for attr_class, attr in attrs.items()}
+
+
+class StringTable:
+    """
+    Append-only table of interned strings. Equal strings share one slot.
+    Replaced strings stay in the table until it is rebuilt by `CompactTree.compact`.
+    """
+
+    __slots__ = ("_strings", "_index")
+
+    def __init__(self):
+        self._strings: List[str] = []
+        self._index: Dict[str, int] = {}
+
+    def add(self, s: str) -> int:
+        i = self._index.get(s)
+        if i is None:
+            i = len(self._strings)
+            self._strings.append(s)
+            self._index[s] = i
+        return i
+
+    def __getitem__(self, i: int) -> str:
+        return self._strings[i]
+
+    def __len__(self):
+        return len(self._strings)
+
+    def rebuild(self, ids: array) -> Tuple[StringTable, array]:
+        """
+        :return: A table of only the strings at `ids`, and their ids in it
+        """
+        table = StringTable()
+        strings = self._strings
+        return table, array("q", (table.add(strings[i]) for i in ids))
+
+
+class _Adjacency:
+    """
+    CSR adjacency with per-node overflow lists for edits since the last compaction.
+    """
+
+    __slots__ = ("offsets", "targets", "overflow")
+
+    def __init__(self):
+        self.offsets = array("q", [0])
+        self.targets = array("q")
+        self.overflow: Dict[int, List[int]] = {}
+
+    def get(self, i: int):
+        edited = self.overflow.get(i)
+        if edited is not None:
+            return edited
+        if i + 1 < len(self.offsets):
+            return self.targets[self.offsets[i]:self.offsets[i + 1]]
+        return ()
+
+    def editable(self, i: int) -> List[int]:
+        edited = self.overflow.get(i)
+        if edited is None:
+            edited = list(self.get(i))
+            self.overflow[i] = edited
+        return edited
+
+    def compact(self, n_nodes: int):
+        offsets = array("q", [0])
+        targets = array("q")
+        for i in range(n_nodes):
+            targets.extend(self.get(i))
+            offsets.append(len(targets))
+        self.offsets = offsets
+        self.targets = targets
+        self.overflow = {}
+
+
+class CompactTree:
+    """
+    Columnar storage for large trees.
+    """
+
+    def __init__(self):
+        self.titles = StringTable()
+        self.contents = StringTable()
+        self._title_ids = array("q")
+        self._content_ids = array("q")
+        self._children = _Adjacency()
+        self._parents = _Adjacency()
+        # Attrs are rare, so they are stored sparsely
+        self._attrs: Dict[int, Dict[Type[Attr], Attr]] = {}
+        # Node ids are derived from the index, under a random per-store namespace
+        self._id_base = random_namespace() << COUNTER_BITS
+        # Whether titles or contents were replaced since the last compaction
+        self._replaced_strings = False
+
+    def __len__(self):
+        return len(self._title_ids)
+
+    def new_node(self, title="", content="") -> CompactNode:
+        self._title_ids.append(self.titles.add(title))
+        self._content_ids.append(self.contents.add(content))
+        return CompactNode(self, len(self._title_ids) - 1)
+
+    def node(self, index: int) -> CompactNode:
+        return CompactNode(self, index)
+
+    def compact(self):
+        """
+        Fold all edits since the last compaction back into the CSR arrays,
+        and drop the titles and contents that are no longer used.
+        """
+        self._children.compact(len(self))
+        self._parents.compact(len(self))
+        if self._replaced_strings:
+            self.titles, self._title_ids = self.titles.rebuild(self._title_ids)
+            self.contents, self._content_ids = self.contents.rebuild(self._content_ids)
+            self._replaced_strings = False
+
+    """
+    ## Conversion from and to `Node`
+    """
+
+    @staticmethod
+    def from_node(root: Node) -> CompactNode:
+        """
+        Copy the subtree of `root` into a new store.
+        The attrs are forked for the new nodes, so changing them leaves the original nodes untouched.
+        :return: The view of the root in the new store
+        """
+        tree = CompactTree()
+        index: Dict[Node, int] = {}
+        nodes = list(root.iter_subtree_with_bfs())
+        for node in nodes:
+            index[node] = len(tree)
+            tree.new_node(node.title, node.content)
+            if len(node.read_attrs()) > 0:
+                tree._attrs[index[node]] = _fork_attrs(node.read_attrs(), tree.node(index[node]))
+        for adjacency, attr_name in ((tree._children, "children"), (tree._parents, "parents")):
+            for node in nodes:
+                adjacency.targets.extend(index[other] for other in getattr(node, attr_name)
+                                         if other in index)
+                adjacency.offsets.append(len(adjacency.targets))
+        return tree.node(0)
+
+    def to_node(self, index: int = 0) -> Node:
+        """
+        Copy the subtree under `index` back into ordinary `Node` objects, with forks of the attrs.
+        """
+        node_map: Dict[int, Node] = {}
+        indices = [view._index for view in self.node(index).iter_subtree_with_bfs()]
+        for i in indices:
+            node = Node(self.titles[self._title_ids[i]], self.contents[self._content_ids[i]])
+            if len(self._attrs.get(i, ())) > 0:
+                node.attrs = _fork_attrs(self._attrs[i], node)
+            node_map[i] = node
+        for i in indices:
+            node = node_map[i]
+            node.children = [node_map[j] for j in self._children.get(i)]
+            node.parents = [node_map[j] for j in self._parents.get(i) if j in node_map]
+        return node_map[index]
+
+
+class _SparseAttrs(MutableMapping):
+    """
+    The attrs of a node of a `CompactTree`. The dict of the node is only created by the first write
+    """
+
+    __slots__ = ("_tree", "_index")
+
+    def __init__(self, tree: CompactTree, index: int):
+        self._tree = tree
+        self._index = index
+
+    def _read(self) -> Mapping[Type[Attr], Attr]:
+        return self._tree._attrs.get(self._index, {})
+
+    def __getitem__(self, attr_class: Type[Attr]) -> Attr:
+        return self._read()[attr_class]
+
+    def __iter__(self):
+        return iter(self._read())
+
+    def __len__(self):
+        return len(self._read())
+
+    def __setitem__(self, attr_class: Type[Attr], attr: Attr):
+        self._tree._attrs.setdefault(self._index, {})[attr_class] = attr
+
+    def __delitem__(self, attr_class: Type[Attr]):
+        attrs = self._tree._attrs[self._index]
+        del attrs[attr_class]
+        if len(attrs) == 0:
+            del self._tree._attrs[self._index]
+
+
+class CompactNode:
+    """
+    A lightweight view of one node in a `CompactTree`.
+    Two views are equal if they point to the same node.
+    """
+
+    __slots__ = ("_tree", "_index")
+
+    def __init__(self, tree: CompactTree, index: int):
+        self._tree = tree
+        self._index = index
+
+    """
+    ## Data of the node
+    """
+
+    @property
+    def title(self) -> str:
+        return self._tree.titles[self._tree._title_ids[self._index]]
+
+    @title.setter
+    def title(self, title: str):
+        self._tree._title_ids[self._index] = self._tree.titles.add(title)
+        self._tree._replaced_strings = True
+
+    @property
+    def content(self) -> str:
+        return self._tree.contents[self._tree._content_ids[self._index]]
+
+    @content.setter
+    def content(self, content: str):
+        self._tree._content_ids[self._index] = self._tree.contents.add(content)
+        self._tree._replaced_strings = True
+
+    @property
+    def node_id(self) -> int:
+        return self._tree._id_base | self._index
+
+    @property
+    def tree(self) -> CompactTree:
+        """
+        The store holding the node
+        """
+        return self._tree
+
+    @property
+    def attrs(self) -> MutableMapping[Type[Attr], Attr]:
+        return _SparseAttrs(self._tree, self._index)
+
+    @property
+    def dirty(self) -> bool:
+        """
+        Compact trees are not journaled, so their nodes are never clean
+        """
+        return True
+
+    @dirty.setter
+    def dirty(self, dirty: bool):
+        pass
+
+    def mark_dirty(self):
+        """
+        Compact trees are not journaled, so there is nothing to track
+        """
+        pass
+
+    """
+    ## Functions for getting the relation of nodes
+    """
+
+    @property
+    def children(self) -> List[CompactNode]:
+        tree = self._tree
+        return [CompactNode(tree, i) for i in tree._children.get(self._index)]
+
+    @property
+    def _child_list(self) -> List[CompactNode]:
+        """
+        The children, as read by `fibers.tree.traversal` and `fibers.tree.loops`
+        """
+        return self.children
+
+    @property
+    def parents(self) -> List[CompactNode]:
+        tree = self._tree
+        return [CompactNode(tree, i) for i in tree._parents.get(self._index)]
+
+    def parent(self) -> CompactNode | None:
+        return self._parent
+
+    @property
+    def _parent(self):
+        parents = self._tree._parents.get(self._index)
+        return CompactNode(self._tree, parents[0]) if len(parents) > 0 else None
+
+    def first_child(self) -> CompactNode | None:
+        children = self._tree._children.get(self._index)
+        return CompactNode(self._tree, children[0]) if len(children) > 0 else None
+
+    def has_child(self):
+        return len(self._tree._children.get(self._index)) > 0
+
+    def is_empty(self):
+        return len(self.content) == 0
+
+    def is_root(self):
+        return len(self._tree._parents.get(self._index)) == 0
+
+    def sibling(self) -> List[CompactNode] | None:
+        return self._parent.children
+
+    def index_in_siblings(self) -> int:
+        return list(self._tree._children.get(self._parent._index)).index(self._index)
+
+    def root(self) -> CompactNode:
+        return self.path_to_root()[-1]
+
+    def find_loop(self) -> List[CompactNode] | None:
+        return loops.find_loop(self)
+
+    def find_loops(self) -> List[List[CompactNode]]:
+        return loops.find_loops(self)
+
+    def path_to_root(self) -> List[CompactNode]:
+        ancestors = []
+        curr_node = self
+        while curr_node is not None:
+            ancestors.append(curr_node)
+            curr_node = curr_node._parent
+        return ancestors
+
+    """
+    ## Functions for changing the structure
+    """
+
+    def add_child(self, node: CompactNode | Node) -> CompactNode:
+        if not isinstance(node, CompactNode) or node._tree is not self._tree:
+            node = self._import(node)
+        self._tree._children.editable(self._index).append(node._index)
+        self._tree._parents.editable(node._index).append(self._index)
+        return node
+
+    def _import(self, node: CompactNode | Node) -> CompactNode:
+        """
+        Copy a node from another tree into this store, together with its subtree
+        """
+        if isinstance(node, CompactNode):
+            node = node._tree.to_node(node._index)
+        index: Dict[Node, CompactNode] = {}
+        for original in node.iter_subtree_with_bfs():
+            new_node = self._tree.new_node(original.title, original.content)
+            if len(original.read_attrs()) > 0:
+                self._tree._attrs[new_node._index] = _fork_attrs(original.read_attrs(), new_node)
+            index[original] = new_node
+        for original, new_node in index.items():
+            for child in original.children:
+                new_node.add_child(index[child])
+        return index[node]
+
+    def new_child(self, title=None) -> CompactNode:
+        node = self._tree.new_node()
+        self.add_child(node)
+        if title is not None:
+            node.title = title
+        return node
+
+    def s(self, title: str) -> CompactNode:
+        """
+        :return: The new child node
+        """
+        return self.new_child(title)
+
+    def be(self, content: str) -> CompactNode:
+        """
+        :return: The node itself
+        """
+        self.content = content
+        return self
+
+    def remove_child(self, node: CompactNode):
+        children = self._tree._children.editable(self._index)
+        if node._index in children:
+            children.remove(node._index)
+        parents = self._tree._parents.editable(node._index)
+        if self._index in parents:
+            parents.remove(self._index)
+
+    def remove_self(self):
+        for parent in self.parents:
+            parent.remove_child(self)
+
+    def change_parent(self, parent: CompactNode) -> CompactNode:
+        self.remove_self()
+        parent.add_child(self)
+        return self
+
+    """
+    ## Node iterators
+    """
+
+    def iter_subtree_with_dfs(self, exclude_self=False) -> Iterator[CompactNode]:
+        """
+        Iterate the subtree with depth first search.
+        Output the deepest nodes first.
+        """
+        tree = self._tree
+        visited = {self._index}
+        stack = [(self._index, iter(tree._children.get(self._index)))]
+        while len(stack) > 0:
+            index, children = stack[-1]
+            for child in children:
+                if child not in visited:
+                    visited.add(child)
+                    stack.append((child, iter(tree._children.get(child))))
+                    break
+            else:
+                stack.pop()
+                if index != self._index or not exclude_self:
+                    yield CompactNode(tree, index)
+
+    def iter_subtree_with_bfs(self, exclude_self=False) -> Iterator[CompactNode]:
+        """
+        Iterate the tree with breath first search.
+        Output the shallowest nodes first.
+        """
+        tree = self._tree
+        visited = {self._index}
+        if not exclude_self:
+            yield self
+        queue = [self._index]
+        for index in queue:
+            for child in tree._children.get(index):
+                if child not in visited:
+                    visited.add(child)
+                    queue.append(child)
+                    yield CompactNode(tree, child)
+
+    def iter_subtree(self, order: Order = "pre", max_depth: int = None,
+                     prune: Callable[[CompactNode], bool] = None, exclude_self=False) -> Iterator[CompactNode]:
+        """
+        Iterate the subtree in the given order. See `fibers.tree.traversal.walk`
+        """
+        return walk(self, order, max_depth=max_depth, prune=prune, exclude_self=exclude_self)
+
+    def get_nodes_in_subtree(self) -> List[CompactNode]:
+        return list(self.iter_subtree_with_dfs())
+
+    """
+    ## Node attrs related functions
+    """
+
+    def read_attrs(self) -> Mapping[Type[Attr], Attr]:
+        return self._tree._attrs.get(self._index, {})
+
+    def has_attr(self, attr_class: Type[Attr]):
+        return attr_class in self._tree._attrs.get(self._index, ())
+
+    def get_attr(self, attr_class: Type[Attr]):
+        attr_value = self.get_attr_or_none(attr_class)
+        if attr_value is None:
+            return attr_class(self)
+        return attr_value
+
+    def get_attr_or_none(self, attr_class: Type[Attr]):
+        return self._tree._attrs.get(self._index, {}).get(attr_class, None)
+
+    """
+    ## Persistence
+    """
+
+    def save_sub_tree(self, path):
+        """
+        Save the subtree to `path` in the binary format of `fibers.tree.persistence`.
+        `Node.read_tree` loads it back as ordinary nodes
+        """
+        from fibers.tree.persistence import save_tree
+        save_tree(self, path)
+
+    """
+    ## Magic functions
+    """
+
+    def __repr__(self):
+        return f"CompactNode({str(self.title)})"
+
+    def __hash__(self):
+        return hash((id(self._tree), self._index))
+
+    def __eq__(self, other):
+        return isinstance(other, CompactNode) and other._tree is self._tree and other._index == self._index
@@ -0,0 +1,123 @@
+from __future__ import annotations
+
+import os
+from typing import List, Set
+
+from fibers.tree.node import Node
+from fibers.tree.persistence import TreeWriter, read_tree, save_tree
+
+"""
+# Incremental saving
+
+`TreeJournal` saves a tree to a file as a full snapshot (a checkpoint) followed by
+delta segments, each holding only the nodes that changed since the previous save.
+`read_tree` replays the segments, and `compact` folds them into a new snapshot.
+
+While a journal is open, nodes register themselves in `Node.dirty_registry` when
+they become dirty, so `save` does not need to walk the tree.
+
+journal = TreeJournal(root, "tree.fib")
+... edit the tree ...
+journal.save()
+"""
+
+_n_open_journals = 0
+
+
+class TreeJournal:
+    def __init__(self, root: Node, path: str, max_segments=64):
+        """
+        :param max_segments: Compact the file after this many delta segments
+        """
+        global _n_open_journals
+        self.root = root
+        self.path = path
+        self.max_segments = max_segments
+        self.n_segments = 0
+        # The ids of the nodes in the file
+        self.saved_ids: Set[int] | None = None
+        if Node.dirty_registry is None:
+            Node.dirty_registry = {}
+        _n_open_journals += 1
+        self.closed = False
+
+    @classmethod
+    def open(cls, path: str, max_segments=64) -> TreeJournal:
+        """
+        Load the tree in `path` and continue journaling into it.
+        """
+        journal = cls(read_tree(path), path, max_segments)
+        journal.saved_ids = {node.node_id for node in journal.root.iter_subtree_with_bfs()}
+        return journal
+
+    def close(self):
+        global _n_open_journals
+        if self.closed:
+            return
+        self.closed = True
+        _n_open_journals -= 1
+        if _n_open_journals == 0:
+            Node.dirty_registry = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def checkpoint(self):
+        """
+        Rewrite the whole tree into the file, dropping all delta segments.
+        """
+        save_tree(self.root, self.path)
+        self.saved_ids = {node.node_id for node in self.root.iter_subtree_with_bfs()}
+        self.n_segments = 0
+
+    compact = checkpoint
+
+    def dirty_nodes(self) -> List[Node]:
+        """
+        :return: The dirty nodes of the tree. They are the dirty nodes that were saved
+        before, and the new nodes under them
+        """
+        res = []
+        # The ids of the node objects in res. Nodes compare by node id, and other trees,
+        # such as snapshots read from the same file, may hold nodes with the same ids
+        seen = set()
+        for node_ref in list(Node.dirty_registry.values()):
+            node = node_ref()
+            if node is not None and node.dirty and node.node_id in self.saved_ids and id(node) not in seen:
+                seen.add(id(node))
+                res.append(node)
+        # New nodes can only be reached from a changed node
+        for node in res:
+            for child in node.children:
+                if child.node_id not in self.saved_ids and id(child) not in seen:
+                    seen.add(id(child))
+                    res.append(child)
+        return res
+
+    def save(self) -> int:
+        """
+        Append the nodes changed since the last save to the file.
+        :return: The number of nodes written
+        """
+        if self.saved_ids is None or not os.path.exists(self.path):
+            self.checkpoint()
+            return len(self.saved_ids)
+        if self.n_segments >= self.max_segments:
+            self.checkpoint()
+            return len(self.saved_ids)
+        nodes = self.dirty_nodes()
+        if len(nodes) == 0:
+            return 0
+        with open(self.path, "ab") as f:
+            writer = TreeWriter(f, delta=True, mark_clean=True)
+            for node in nodes:
+                writer.write_node(node)
+            writer.close(self.root)
+        for node in nodes:
+            self.saved_ids.add(node.node_id)
+            Node.dirty_registry.pop(id(node), None)
+        self.n_segments += 1
+        return len(nodes)
@@ -0,0 +1,131 @@
+from __future__ import annotations
+
+from typing import TYPE_CHECKING, Dict, List
+
+if TYPE_CHECKING:
+    from fibers.tree import Node
+
+"""
+# Loop detection
+
+The children of a node may have several parents, so a tree is a directed graph
+that can contain loops after careless edits. `find_loops` finds them with one
+iterative depth-first search that visits every node and edge once.
+
+`LoopValidator` checks every `add_child` while it is active:
+
+with LoopValidator() as validator:
+    merge_generated_nodes(root)
+print(validator.loops)
+"""
+
+# Nodes on the current path are grey. Fully explored nodes are black
+_GREY = 1
+_BLACK = 2
+
+
+def find_loops(root: Node, first_only=False) -> List[List[Node]]:
+    """
+    Find the loops reachable from `root`. Every loop in the subtree shares a node
+    with at least one of the reported loops.
+    :param first_only: Stop at the first loop found
+    :return: The loops, each as a list of nodes where the last node is a parent of the first one
+    """
+    loops = []
+    colour: Dict[Node, int] = {root: _GREY}
+    path = [root]
+    position = {root: 0}
+    stack = [iter(root.children)]
+    while len(stack) > 0:
+        for child in stack[-1]:
+            state = colour.get(child)
+            if state is None:
+                colour[child] = _GREY
+                position[child] = len(path)
+                path.append(child)
+                stack.append(iter(child._child_list or ()))
+                break
+            if state == _GREY:
+                loops.append(path[position[child]:])
+                if first_only:
+                    return loops
+        else:
+            node = path.pop()
+            del position[node]
+            colour[node] = _BLACK
+            stack.pop()
+    return loops
+
+
+def find_loop(root: Node) -> List[Node] | None:
+    """
+    :return: A loop reachable from `root` or None if there is none
+    """
+    loops = find_loops(root, first_only=True)
+    return loops[0] if len(loops) > 0 else None
+
+
+def find_path(source: Node, target: Node) -> List[Node] | None:
+    """
+    :return: A path from `source` down to `target` through children, or None if there is none
+    """
+    if source is target:
+        return [source]
+    visited = {source}
+    path = [source]
+    stack = [iter(source.children)]
+    while len(stack) > 0:
+        for child in stack[-1]:
+            if child is target:
+                path.append(child)
+                return path
+            if child not in visited:
+                visited.add(child)
+                path.append(child)
+                stack.append(iter(child._child_list or ()))
+                break
+        else:
+            path.pop()
+            stack.pop()
+    return None
+
+
+class LoopFound(Exception):
+    def __init__(self, loop: List[Node]):
+        super().__init__(" -> ".join(node.title for node in loop))
+        self.loop = loop
+
+
+class LoopValidator:
+    """
+    While active, every `add_child` checks whether the new edge closes a loop.
+    Only the part of the tree under the new child is searched.
+    """
+
+    def __init__(self, raise_on_loop=False):
+        """
+        :param raise_on_loop: Raise `LoopFound` when a loop is closed, after the edge is added.
+        Otherwise the loops are collected in `self.loops`
+        """
+        self.raise_on_loop = raise_on_loop
+        self.loops: List[List[Node]] = []
+        self._previous: LoopValidator | None = None
+
+    def check_edge(self, parent: Node, child: Node):
+        loop = find_path(child, parent)
+        if loop is None:
+            return
+        self.loops.append(loop)
+        if self.raise_on_loop:
+            raise LoopFound(loop)
+
+    def __enter__(self) -> LoopValidator:
+        from fibers.tree import Node
+        self._previous = Node.loop_validator
+        Node.loop_validator = self
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        from fibers.tree import Node
+        Node.loop_validator = self._previous
+        self._previous = None
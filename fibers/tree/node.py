@@ -1,60 +1,182 @@
 from __future__ import annotations
 
-import uuid
-from copy import copy
-from typing import TYPE_CHECKING, Dict, List, Type, Set
+from types import MappingProxyType
+from typing import TYPE_CHECKING, Callable, Dict, List, Mapping, Type
+from weakref import ref
 
-import dill
+from fibers.tree import ancestry, loops
+from fibers.tree.node_id import NodeIdAllocator
+from fibers.tree.node_list import NodeList
+from fibers.tree.traversal import walk, Order
 
 if TYPE_CHECKING:
     from fibers.tree.node_attr import Attr
 
+
+# The attrs of the nodes without any
+_no_attrs: Mapping[Type[Attr], Attr] = MappingProxyType({})
+
+
+class LazyContent:
+    """
+    Content that is only produced when `node.content` is read.
+    Assign an instance to `node.content` to make the content of the node lazy.
+    """
+
+    __slots__ = ()
+
+    def materialize(self) -> str:
+        raise NotImplementedError
+
+    def share(self) -> str | LazyContent:
+        """
+        :return: The content for a copy of the node. Contents that never change can return themselves
+        """
+        return self.materialize()
+
+
+class LazyAttrs:
+    """
+    Attrs that are only built when `node.attrs` is first accessed.
+    """
+
+    __slots__ = ()
+
+    def load(self, node: Node):
+        """
+        Add the attrs to `node`. `node.attrs` is already an empty dict when this is called
+        """
+        raise NotImplementedError
+
+
+class SharedAttrs(LazyAttrs):
+    """
+    The attrs of a copied node, shared with the original until the copy changes them.
+    `has_attr`, `get_attr_or_none` and `read_attrs` read the shared attrs. `get_attr` gives the copy
+    its own fork of the requested attr through `Attr.fork`, and `node.attrs` forks the remaining ones.
+    The original keeps its attrs.
+    """
+
+    __slots__ = ("attrs",)
+
+    def __init__(self, attrs: Dict[Type[Attr], Attr]):
+        # The attrs already forked for the node have it as their node
+        self.attrs = attrs
+
+    def load(self, node: Node):
+        for attr_class, attr in self.attrs.items():
+            node._attrs[attr_class] = attr if attr.node is node else attr.fork(node)
+
+    def fork_attr(self, node: Node, attr_class: Type[Attr]) -> Attr | None:
+        """
+        :return: The attr of `node` of `attr_class`, forked for it if it is still shared
+        """
+        attr = self.attrs.get(attr_class)
+        if attr is None or attr.node is node:
+            return attr
+        attr = attr.fork(node)
+        # Other copies may share this SharedAttrs, so the node gets its own
+        node._attrs = SharedAttrs({**self.attrs, attr_class: attr})
+        return attr
+
+    @staticmethod
+    def share(node: Node, new_node: Node):
+        """
+        Let `new_node` share the attrs of `node`
+        """
+        attrs = node._attrs
+        if isinstance(attrs, SharedAttrs):
+            # A copy of a copy forks from the same originals
+            new_node._attrs = attrs
+        elif len(node.read_attrs()) > 0:
+            new_node._attrs = SharedAttrs(dict(node.read_attrs()))
+
+
 class Node:
     """
     The class for node on the Tree class. It only stores the content of the node.
     The relation between nodes are stored in the Tree class instance (self.tree).
+    For trees with millions of nodes, see `fibers.tree.compact.CompactTree`.
     """
 
+    __slots__ = ("_content", "_title", "_attrs", "node_id", "_child_list", "_parent_list", "dirty",
+                 "version", "_ancestry", "__weakref__")
+
+    # The callable used to allocate node ids. See `fibers.tree.node_id`
+    id_allocator: Callable[[], int] = NodeIdAllocator()
+    # id(node) -> weak reference to the nodes that became dirty while a `TreeJournal` is open.
+    # Keyed by identity, as different nodes can have the same node id. None when no journal is open
+    dirty_registry: Dict[int, ref[Node]] | None = None
+    # Whether to cache the ancestry of nodes for `root`, `depth` and the like. See `fibers.tree.ancestry`
+    ancestry_index = False
+    # The validator checking each `add_child` for loops. See `fibers.tree.loops.LoopValidator`
+    loop_validator: loops.LoopValidator | None = None
+
     def __init__(self, title="", content=""):
         super().__init__()
 
-        # content is string no matter what _content_type is
-        self.content: str = content
+        # content is string no matter what _content_type is. It is stored as a LazyContent until read
+        self._content: str | LazyContent = content
         #
-        self.title: str = title
-        # The attr data is used to store the data of the node
-        self.attrs: Dict[Type[Attr], Attr] = {}
+        self._title: str = title
+        # The attr data is used to store the data of the node. None until `attrs` is first used
+        self._attrs: Dict[Type[Attr], Attr] | LazyAttrs | None = None
         # The node id is used to identify the node
-        self.node_id = uuid.uuid4().int
+        self.node_id = Node.id_allocator()
+        # Increased at every change of the node. See `fibers.gui.renderer.Renderer`
+        self.version = 0
+        # Children and parents are ordered sets. See `NodeList`.
+        # Most nodes are leaves, so the children are None until `children` is first used
+        self._child_list: NodeList | None = None
         #
-        self.children: List[Node] = []
-        #
-        self.parents: List[Node] = []
-        #
-        self.dirty = False
+        self._parent_list = NodeList(owner=self)
+        # Whether the node changed since it was last saved. New nodes have never been saved
+        self.dirty = True
+        if Node.dirty_registry is not None:
+            Node.dirty_registry[id(self)] = ref(self)
+        # The cached entry of the ancestry index
+        self._ancestry = None
+
+    def _copy_data(self) -> Node:
+        """
+        :return: A new node with the title, content and attrs of this node.
+        The content and attrs are shared until one of the nodes changes them
+        """
+        new_node = Node(self._title)
+        content = self._content
+        if isinstance(content, LazyContent):
+            content = content.share()
+        new_node._content = content
+        SharedAttrs.share(self, new_node)
+        return new_node
 
     def copy_to(self):
-        new_node = Node(self.title, self.content)
-        new_node.attrs = copy(self.attrs)
-        new_node.children = copy(self._children)
-        new_node.parents = copy(self.parents)
+        new_node = self._copy_data()
+        new_node.children = self._children
+        new_node.parents = self.parents
         return new_node
 
-    def copy_whole_sub_tree(self):
-        nodes = [node for node in self.iter_subtree_with_dfs()]
-        node_map = {}
-        for node in nodes:
-            node_map[node] = Node(node.title, node.content)
-        for node in nodes:
-            new_node = node_map[node]
-            for child in node.children:
-                new_node._children.append(node_map[child])
-            for parent in node.parents:
-                if parent not in node_map:
-                    continue
-                new_node.parents.append(node_map[parent])
+    def copy_whole_sub_tree(self) -> Dict[Node, Node]:
+        """
+        Copy the subtree, keeping the order of children and parents and nodes with several parents.
+        Contents are shared with the original, and the copies fork the attrs when they first change them
+        (see `SharedAttrs`). The original nodes keep their attrs.
+        :return: A dict from the original nodes to their copies
+        """
+        node_map = {node: node._copy_data() for node in walk(self, "bfs")}
+        for node, new_node in node_map.items():
+            if node.has_child():
+                new_node._child_list = NodeList.of_unique([node_map[child] for child in node.children], new_node)
+            new_node._parent_list = NodeList.of_unique([node_map[parent] for parent in node.parents
+                                                        if parent in node_map], new_node)
         return node_map
 
+    def clone_sub_tree(self) -> Node:
+        """
+        :return: The root of a copy of the subtree. See `copy_whole_sub_tree`
+        """
+        return self.copy_whole_sub_tree()[self]
+
     def update_subtree_parents(self):
         nodes = [node for node in self.iter_subtree_with_dfs()]
         for node in nodes:
@@ -74,10 +196,96 @@ class Node:
                     parent._children.append(node)
 
 
+    """
+    ## Content and attrs
+    """
+
+    @property
+    def content(self) -> str:
+        content = self._content
+        if content.__class__ is str or not isinstance(content, LazyContent):
+            return content
+        return content.materialize()
+
+    @content.setter
+    def content(self, content: str | LazyContent):
+        self._content = content
+        self.mark_dirty()
+
+    @property
+    def title(self) -> str:
+        return self._title
+
+    @title.setter
+    def title(self, title: str):
+        self._title = title
+        self.mark_dirty()
+
+    @property
+    def attrs(self) -> Dict[Type[Attr], Attr]:
+        """
+        The attrs of the node, to change them. Use `read_attrs` to only read them
+        """
+        attrs = self._attrs
+        if attrs is None:
+            attrs = self._attrs = {}
+            return attrs
+        if not isinstance(attrs, LazyAttrs):
+            return attrs
+        self._attrs = {}
+        attrs.load(self)
+        return self._attrs
+
+    @attrs.setter
+    def attrs(self, attrs: Dict[Type[Attr], Attr]):
+        self._attrs = attrs
+        self.mark_dirty()
+
+    def mark_dirty(self):
+        """
+        Mark the node as changed since it was last saved. This is automatic for changes of
+        the title, content, attrs dict and adjacency. Call it after changing the inside of an attr.
+        """
+        self.version += 1
+        if not self.dirty:
+            self.dirty = True
+            if Node.dirty_registry is not None:
+                Node.dirty_registry[id(self)] = ref(self)
+
+    def _adjacency_changed(self, node_list: NodeList):
+        """
+        Called by the NodeLists of the node when they change
+        """
+        self.mark_dirty()
+        entry = self._ancestry
+        if entry is not None and node_list is self._parent_list and entry[3] is not self._parent:
+            ancestry.invalidate(self)
+
     """
     ## Functions for getting the relation of nodes
     """
 
+    @property
+    def children(self) -> NodeList:
+        child_list = self._child_list
+        if child_list is None:
+            child_list = self._child_list = NodeList(owner=self)
+        return child_list
+
+    @children.setter
+    def children(self, children):
+        self._child_list = NodeList(children, owner=self)
+        self.mark_dirty()
+
+    @property
+    def parents(self) -> NodeList:
+        return self._parent_list
+
+    @parents.setter
+    def parents(self, parents):
+        self._parent_list = NodeList(parents, owner=self)
+        self._adjacency_changed(self._parent_list)
+
     @property
     def _children(self):
         return self.children
@@ -98,17 +306,15 @@ class Node:
         if parent is None:
             self.parents = []
             return
-        if parent in self.parents:
-            self.parents.remove(parent)
-        self.parents = [parent]+self.parents
+        self.parents.insert(0, parent)
 
     def first_child(self) -> Node | None:
-        if len(self._children) > 0:
+        if self.has_child():
             return self._children[0]
         return None
 
     def has_child(self):
-        return len(self.children) > 0
+        return self._child_list is not None and len(self._child_list) > 0
 
     def is_empty(self):
         return len(self.content) == 0
@@ -123,9 +329,12 @@ class Node:
         return self.sibling().index(self)
 
     def root(self) -> Node:
-        if self._parent is None:
-            return self
-        return self._parent.root()
+        if Node.ancestry_index:
+            return ancestry.entry(self)[1]
+        curr_node = self
+        while curr_node._parent is not None:
+            curr_node = curr_node._parent
+        return curr_node
 
     def path_to_root(self) -> List[Node]:
         ancestors = []
@@ -135,20 +344,36 @@ class Node:
             curr_node = curr_node._parent
         return ancestors
 
-    def find_loop(self):
-        node_on_path = []
-        def dfs(node):
-            if node in node_on_path:
-                return node_on_path[node_on_path.index(node):]
-            node_on_path.append(node)
-            for child in node.children:
-                loop = dfs(child)
-                if loop is not None:
-                    return loop
-            node_on_path.remove(node)
-            return None
+    def depth(self) -> int:
+        """
+        :return: The number of primary parents between the node and its root
+        """
+        if Node.ancestry_index:
+            return ancestry.entry(self)[0]
+        return len(self.path_to_root()) - 1
+
+    def is_ancestor_of(self, node: Node) -> bool:
+        """
+        :return: Whether the node is `node` or one of its ancestors along the primary parents
+        """
+        if Node.ancestry_index:
+            return ancestry.is_ancestor(self, node)
+        return any(ancestor is self for ancestor in node.path_to_root())
+
+    def lowest_common_ancestor(self, node: Node) -> Node | None:
+        if Node.ancestry_index:
+            return ancestry.lowest_common_ancestor(self, node)
+        ancestors = set(map(id, self.path_to_root()))
+        for ancestor in node.path_to_root():
+            if id(ancestor) in ancestors:
+                return ancestor
+        return None
 
-        return dfs(self)
+    def find_loop(self) -> List[Node] | None:
+        return loops.find_loop(self)
+
+    def find_loops(self) -> List[List[Node]]:
+        return loops.find_loops(self)
 
     def is_root(self):
         return len(self.parents) == 0
@@ -161,6 +386,8 @@ class Node:
     def add_child(self, node: Node) -> Node:
         self._children.append(node)
         node.parents.append(self)
+        if Node.loop_validator is not None:
+            Node.loop_validator.check_edge(self, node)
         return node
 
     def new_child(self, title=None) -> Node:
@@ -202,7 +429,7 @@ class Node:
     """
 
     def remove_self(self):
-        for parent in self.parents:
+        for parent in list(self.parents):
             parent.remove_child(self)
 
     def change_parent(self, parent: Node) -> Node:
@@ -215,12 +442,11 @@ class Node:
     ## Section for extract related nodes
     """
 
-    def get_nodes_in_subtree(self) -> Set[Node]:
+    def get_nodes_in_subtree(self) -> List[Node]:
         """
         Return all the nodes in the subtree
         """
-        nodes = list(self.iter_subtree_with_dfs())
-        return nodes
+        return list(walk(self, "post"))
 
     """
     ## Magic functions
@@ -250,21 +476,7 @@ class Node:
         Output the deepest nodes first.
         :return: An iterator of nodes
         """
-        visited = set()
-        for child in self.children:
-            if child not in visited:
-                visited.add(child)
-                yield from child._iter_subtree_with_dfs(visited)
-        if not exclude_self:
-            yield self
-
-    def _iter_subtree_with_dfs(self, visited: set):
-        for child in self.children:
-            if child not in visited:
-                visited.add(child)
-                yield from child.iter_subtree_with_dfs()
-        yield self
-
+        return walk(self, "post", exclude_self=exclude_self)
 
     def iter_subtree_with_bfs(self, exclude_self=False):
         """
@@ -272,20 +484,15 @@ class Node:
         Output the shallowest nodes first.
         :return: An iterator of nodes
         """
-        stack = [self]
-        visited = set()
-        visited.add(self)
-        if not exclude_self:
-            yield self
-        while len(stack) > 0:
-            curr_node = stack.pop(0)
-            for child in curr_node.children:
-                if child not in visited:
-                    yield child
-                    visited.add(child)
-                    stack.append(child)
-
+        return walk(self, "bfs", exclude_self=exclude_self)
 
+    def iter_subtree(self, order: Order = "pre", max_depth: int = None,
+                     prune: Callable[[Node], bool] = None, exclude_self=False):
+        """
+        Iterate the subtree in the given order. See `fibers.tree.traversal.walk`
+        :return: An iterator of nodes
+        """
+        return walk(self, order, max_depth=max_depth, prune=prune, exclude_self=exclude_self)
 
     """
     ## Node attrs related functions
@@ -293,49 +500,53 @@ class Node:
     Node attrs stores the data of the node for different purposes.
     """
 
+    def read_attrs(self) -> Mapping[Type[Attr], Attr]:
+        """
+        :return: The attrs of the node, without forking the attrs shared with the original of a copy.
+        Do not change them, use `attrs` or `get_attr` for that
+        """
+        attrs = self._attrs
+        if attrs is None:
+            return _no_attrs
+        if isinstance(attrs, SharedAttrs):
+            return attrs.attrs
+        return self.attrs
+
     def has_attr(self, attr_class: Type[Attr]):
-        return attr_class in self.attrs.keys()
+        return attr_class in self.read_attrs()
 
     def get_attr(self, attr_class: Type[Attr]):
-        attr_value = self.get_attr_or_none(attr_class)
+        attrs = self._attrs
+        if isinstance(attrs, SharedAttrs):
+            attr_value = attrs.fork_attr(self, attr_class)
+        else:
+            attr_value = self.get_attr_or_none(attr_class)
         if attr_value is None:
             return attr_class(self)
         return attr_value
 
     def get_attr_or_none(self, attr_class: Type[Attr]):
-        return self.attrs.get(attr_class, None)
+        """
+        The attr is shared with the original if the node is an unchanged copy. Use `get_attr` to change it
+        """
+        return self.read_attrs().get(attr_class, None)
 
     """
     ## Persistence 
     """
 
     def save_sub_tree(self, path):
-        node_dict = {}
-        for node in self.iter_subtree_with_dfs():
-            node_dict[node.node_id] = {
-                "title": node.title,
-                "content": node.content,
-                "children": [child.node_id for child in node.children],
-                "parents": [parent.node_id for parent in node.parents]
-            }
-        with open(path, "wb") as f:
-            f.write(dill.dumps([node_dict, self.node_id]))
-
+        """
+        Save the subtree to `path` in the binary format of `fibers.tree.persistence`
+        """
+        from fibers.tree.persistence import save_tree
+        save_tree(self, path)
 
     @staticmethod
-    def read_tree(path):
-        with open(path, "rb") as f:
-            node_dict, root_id = dill.loads(f.read())
-        nodes = {}
-        for node_id, node_data in node_dict.items():
-            node = Node(node_data["title"], node_data["content"])
-            node.node_id = node_id
-            nodes[node_id] = node
-        for node_id, node_data in node_dict.items():
-            node = nodes[node_id]
-            for child_id in node_data["children"]:
-                node._children.append(nodes[child_id])
-            for parent_id in node_data["parents"]:
-                node.parents.append(nodes[parent_id])
-        return nodes[root_id]
-
+    def read_tree(path, lazy=False, cache_size=1024) -> Node:
+        """
+        :param lazy: Keep the contents and attrs in the memory-mapped file until they are accessed
+        :param cache_size: The number of decoded contents kept in memory when `lazy` is true
+        """
+        from fibers.tree import persistence
+        return persistence.read_tree(path, lazy=lazy, cache_size=cache_size)
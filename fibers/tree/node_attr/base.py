@@ -1,4 +1,5 @@
 from __future__ import annotations
+from copy import copy
 from typing import TYPE_CHECKING
 
 from fibers.gui.renderer import Rendered
@@ -12,6 +13,7 @@ class Attr:
         if self.__class__ in node.attrs:
             raise Exception(f"Node {node} already has attr {self.__class__}")
         node.attrs[self.__class__] = self
+        node.mark_dirty()
         self.node: Node = node
 
     @classmethod
@@ -24,6 +26,28 @@ class Attr:
     def handle_message(self, message) -> MessageResult:
         pass
 
+    def fork(self, node: Node) -> Attr:
+        """
+        :return: A copy of the attr for `node`, used when copying trees.
+        Override this if the attr holds mutable data that should not be shared between the copies
+        """
+        new_attr = copy(self)
+        new_attr.node = node
+        return new_attr
+
+    def serialize(self):
+        """
+        :return: A JSON-compatible payload to save with the tree, or None if the attr is not saved
+        """
+        return None
+
+    @classmethod
+    def deserialize(cls, node: Node, payload) -> Attr:
+        """
+        Rebuild the attr on `node` from the payload returned by `serialize`
+        """
+        raise NotImplementedError
+
 
 class MessageResult:
     def __init__(self):
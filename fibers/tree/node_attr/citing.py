@@ -15,6 +15,12 @@ class Citing(Attr):
 
     def add_citation(self, node: Node):
         self.citing_nodes.append(node)
+        self.node.mark_dirty()
+
+    def fork(self, node: Node):
+        attr = super().fork(node)
+        attr.citing_nodes = list(self.citing_nodes)
+        return attr
 
     def render(self, rendered):
         if len(self.citing_nodes) > 0:
@@ -2,7 +2,9 @@ from __future__ import annotations
 
 import html
 import inspect
-from typing import TYPE_CHECKING, Any
+import linecache
+import os
+from typing import TYPE_CHECKING, Any, Dict, Iterable
 
 from .base import Attr
 
@@ -17,16 +19,17 @@ class CodeData(Attr):
 
     def render(self, rendered):
         content = []
-        if get_type(self.node) in ["function", "example"]:
+        obj_type = self.obj_type
+        if obj_type in ["function", "example"]:
             content.append(f"""
         <Code
-        code="{html.escape(get_source(self.node))}"
+        code="{source_cache.get(self.obj).escaped}"
         """ + f"""
         language="python"
         />
         
         """)
-        content.append(f"Type: {get_type(self.node)}")
+        content.append(f"Type: {obj_type}")
 
         del rendered.tabs["content"]
         rendered.tabs["code"] = "<br/>".join(content)
@@ -38,6 +41,7 @@ def set_code_obj(node: Node, type_name: str, obj: Any):
     code_data = CodeData(node)
     code_data.obj_type = type_name
     code_data.obj = obj
+    node.mark_dirty()
 
 def get_type(node: Node):
     return node.get_attr(CodeData).obj_type
@@ -51,5 +55,108 @@ def get_docs(node: Node):
 
 def get_source(node: Node):
     obj = get_obj(node)
-    # get source by inspect
-    return inspect.getsource(obj)
\ No newline at end of file
+    return source_cache.get(obj).source
+
+
+"""
+## Source cache
+
+`inspect.getsource` checks and reads the source file at every call. The source
+of each object is kept in `source_cache` with the modification time of its file,
+so rendering code nodes again does not touch the filesystem. Call
+`source_cache.refresh()` to drop the sources of the files changed since.
+"""
+
+
+class SourceEntry:
+    __slots__ = ("obj", "path", "mtime", "source", "_escaped")
+
+    def __init__(self, obj, path, mtime, source):
+        # Kept so that the id of the object is not reused while it is cached
+        self.obj = obj
+        self.path = path
+        self.mtime = mtime
+        self.source = source
+        self._escaped = None
+
+    @property
+    def escaped(self) -> str:
+        if self._escaped is None:
+            self._escaped = html.escape(self.source)
+        return self._escaped
+
+
+class SourceCache:
+    def __init__(self):
+        # id(obj) -> entry
+        self.entries: Dict[int, SourceEntry] = {}
+
+    def get(self, obj) -> SourceEntry:
+        entry = self.entries.get(id(obj))
+        if entry is not None and entry.obj is obj:
+            return entry
+        return self._load(obj, {})
+
+    def _load(self, obj, mtimes: Dict[str, int]) -> SourceEntry:
+        """
+        :param mtimes: The modification times of the files already checked
+        """
+        path = inspect.getsourcefile(obj) or inspect.getfile(obj)
+        if path not in mtimes:
+            mtimes[path] = _mtime(path)
+            # Read the file again if it changed since linecache read it
+            linecache.checkcache(path)
+        entry = SourceEntry(obj, path, mtimes[path], inspect.getsource(obj))
+        self.entries[id(obj)] = entry
+        return entry
+
+    def warm(self, objs: Iterable):
+        """
+        Load the sources of `objs`, checking each file once.
+        Objects without source are skipped
+        """
+        mtimes = {}
+        for obj in objs:
+            entry = self.entries.get(id(obj))
+            if entry is not None and entry.obj is obj:
+                continue
+            try:
+                self._load(obj, mtimes)
+            except (OSError, TypeError):
+                pass
+
+    def refresh(self):
+        """
+        Drop the sources of the files modified since they were read
+        """
+        mtimes = {}
+        for key, entry in list(self.entries.items()):
+            if entry.path not in mtimes:
+                mtimes[entry.path] = _mtime(entry.path)
+            if mtimes[entry.path] != entry.mtime:
+                del self.entries[key]
+
+    def clear(self):
+        self.entries.clear()
+
+
+def _mtime(path: str) -> int | None:
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+source_cache = SourceCache()
+
+
+def warm_source_cache(root: Node):
+    """
+    Load the sources of the code nodes in the subtree of `root`
+    """
+    objs = []
+    for node in root.iter_subtree_with_dfs():
+        code_data = node.read_attrs().get(CodeData)
+        if code_data is not None and code_data.obj_type in ["function", "example"]:
+            objs.append(code_data.obj)
+    source_cache.warm(objs)
@@ -0,0 +1,70 @@
+from __future__ import annotations
+
+import itertools
+import os
+import uuid
+from contextlib import contextmanager
+from typing import Callable
+
+"""
+# Node id allocation
+
+Node ids are integers made of a 64-bit random namespace prefix and a 40-bit
+monotonic counter. Allocation is a single counter step. Two of n allocators
+(or `CompactTree`s) share a namespace with a probability of about n^2 / 2^65,
+so trees built by different allocators or processes can be merged without
+their ids colliding in practice. The ids do not fit in 64 bits, and are saved
+as wide ids by `fibers.tree.persistence`.
+
+Ids persisted by older versions are 128-bit `uuid4` ints, which can live in
+the same tree.
+"""
+
+NAMESPACE_BITS = 64
+COUNTER_BITS = 40
+
+
+def random_namespace() -> int:
+    return int.from_bytes(os.urandom(NAMESPACE_BITS // 8), "little")
+
+
+class NodeIdAllocator:
+    """
+    Allocate ids as `namespace << COUNTER_BITS | counter`.
+    The sequence is deterministic for a given namespace.
+    """
+
+    def __init__(self, namespace: int = None):
+        if namespace is None:
+            namespace = random_namespace()
+        assert 0 <= namespace < (1 << NAMESPACE_BITS)
+        self.namespace = namespace
+        self._counter = itertools.count(namespace << COUNTER_BITS)
+
+    def __call__(self) -> int:
+        return next(self._counter)
+
+
+def uuid_allocator() -> int:
+    """
+    The allocator used by older versions. Slower, but unique without coordination.
+    """
+    return uuid.uuid4().int
+
+
+@contextmanager
+def use_id_allocator(allocator: Callable[[], int]):
+    """
+    Use `allocator` for all nodes created in the block. For example, to build a tree
+    with reproducible ids:
+
+    with use_id_allocator(NodeIdAllocator(namespace=1)):
+        root = markdown_to_tree(src)
+    """
+    from fibers.tree.node import Node
+    old_allocator = Node.id_allocator
+    Node.id_allocator = allocator
+    try:
+        yield allocator
+    finally:
+        Node.id_allocator = old_allocator
@@ -0,0 +1,226 @@
+from __future__ import annotations
+
+from typing import Iterable, List, Dict, Any, Tuple
+
+
+class NodeList:
+    """
+    An ordered set of nodes, used for `Node.children` and `Node.parents`.
+    It behaves like a list without duplicates, but `append`, `remove` and `in` are O(1)
+    and `index` and indexing by position are O(log n).
+
+    Most nodes have a few children and one parent, so short lists are stored as tuples,
+    which are smaller than lists, and empty lists share the empty tuple.
+    Once a list grows past `SMALL_SIZE`, it becomes a list with a dict from node to slot. Removed nodes
+    then leave a hole in `_items`. The number of holes before each slot is kept in a
+    Fenwick tree, so positions can be computed without shifting the list.
+    The holes are squeezed out once they make up half of the list.
+
+    Changes are reported to `owner`, if given.
+    """
+
+    __slots__ = ("_items", "_slot", "_holes", "_n_holes", "_owner")
+
+    SMALL_SIZE = 8
+
+    def __init__(self, nodes: Iterable = (), owner=None):
+        self._owner = None
+        self._items: Tuple | List[Any] = ()
+        # Only built for long lists
+        self._slot: Dict[Any, int] | None = None
+        # Fenwick tree over the holes. Only built after the first removal from a long list
+        self._holes: List[int] | None = None
+        self._n_holes = 0
+        for node in nodes:
+            self.append(node)
+        self._owner = owner
+
+    @classmethod
+    def of_unique(cls, nodes: List, owner=None) -> NodeList:
+        """
+        Build a NodeList from a list of distinct nodes, without checking for duplicates.
+        Long lists are adopted, not copied
+        """
+        node_list = cls(owner=owner)
+        node_list._squeeze(nodes)
+        return node_list
+
+    """
+    ## Editing
+    """
+
+    def _changed(self):
+        if self._owner is not None:
+            self._owner._adjacency_changed(self)
+
+    def append(self, node):
+        if self._slot is None:
+            if node not in self._items:
+                if len(self._items) < self.SMALL_SIZE:
+                    self._items += (node,)
+                else:
+                    self._squeeze([*self._items, node])
+                self._changed()
+            return
+        if node in self._slot:
+            return
+        self._slot[node] = len(self._items)
+        self._items.append(node)
+        holes = self._holes
+        if holes is not None:
+            # The new entry of the Fenwick tree covers the slots (i - lowbit(i), i]
+            i = len(self._items)
+            holes.append(self._count_holes(i - 1) - self._count_holes(i - (i & -i)))
+        self._changed()
+
+    def extend(self, nodes: Iterable):
+        for node in nodes:
+            self.append(node)
+
+    def remove(self, node):
+        if self._slot is None:
+            items = list(self._items)
+            items.remove(node)
+            self._items = tuple(items)
+            self._changed()
+            return
+        try:
+            slot = self._slot.pop(node)
+        except KeyError:
+            raise ValueError(f"{node} is not in the list")
+        self._items[slot] = None
+        self._n_holes += 1
+        if self._n_holes > 16 and 2 * self._n_holes > len(self._items):
+            self._squeeze(list(self))
+        elif self._holes is None:
+            self._build_holes()
+        else:
+            i = slot + 1
+            holes = self._holes
+            while i < len(holes):
+                holes[i] += 1
+                i += i & -i
+        # Reported after the change, so that the owner sees the new first entry
+        self._changed()
+
+    def insert(self, index: int, node):
+        """
+        Insert `node` before position `index`. If `node` is already in the list, it is moved.
+        This is O(n) and meant for short lists such as `parents`.
+        """
+        nodes = [other for other in self if other != node]
+        nodes.insert(index, node)
+        self._squeeze(nodes)
+        self._changed()
+
+    def clear(self):
+        self._squeeze([])
+        self._changed()
+
+    def copy(self) -> NodeList:
+        """
+        :return: A copy without owner
+        """
+        return NodeList(self)
+
+    """
+    ## Position queries
+    """
+
+    def index(self, node) -> int:
+        if self._slot is None:
+            return self._items.index(node)
+        try:
+            slot = self._slot[node]
+        except KeyError:
+            raise ValueError(f"{node} is not in the list")
+        if self._n_holes == 0:
+            return slot
+        return slot - self._count_holes(slot)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(self)[index]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("NodeList index out of range")
+        if self._n_holes == 0:
+            return self._items[index]
+        # Find the slot with exactly `index` live entries before it
+        holes = self._holes
+        pos = 0
+        remaining = index + 1
+        step = 1 << (len(holes) - 1).bit_length()
+        while step > 0:
+            next_pos = pos + step
+            if next_pos < len(holes) and step - holes[next_pos] < remaining:
+                pos = next_pos
+                remaining -= step - holes[next_pos]
+            step >>= 1
+        return self._items[pos]
+
+    def _count_holes(self, n_slots: int) -> int:
+        """
+        :return: The number of holes in the first `n_slots` slots
+        """
+        holes = self._holes
+        count = 0
+        while n_slots > 0:
+            count += holes[n_slots]
+            n_slots -= n_slots & -n_slots
+        return count
+
+    def _build_holes(self):
+        holes = [0] * (len(self._items) + 1)
+        for slot, node in enumerate(self._items):
+            if node is None:
+                holes[slot + 1] += 1
+        for i in range(1, len(holes)):
+            parent = i + (i & -i)
+            if parent < len(holes):
+                holes[parent] += holes[i]
+        self._holes = holes
+
+    def _squeeze(self, nodes: List):
+        if len(nodes) > self.SMALL_SIZE:
+            self._items = nodes
+            self._slot = {node: slot for slot, node in enumerate(nodes)}
+        else:
+            self._items = tuple(nodes)
+            self._slot = None
+        self._holes = None
+        self._n_holes = 0
+
+    """
+    ## List protocol
+    """
+
+    def __len__(self):
+        return len(self._items) - self._n_holes
+
+    def __iter__(self):
+        # Nodes are always truthy, so this skips exactly the holes
+        return filter(None, self._items)
+
+    def __reversed__(self):
+        return filter(None, reversed(self._items))
+
+    def __contains__(self, node):
+        if self._slot is None:
+            return node in self._items
+        return node in self._slot
+
+    def __eq__(self, other):
+        if isinstance(other, (NodeList, list, tuple)):
+            return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+        return NotImplemented
+
+    def __add__(self, other):
+        return list(self) + list(other)
+
+    def __radd__(self, other):
+        return list(other) + list(self)
+
+    def __repr__(self):
+        return repr(list(self))
@@ -0,0 +1,590 @@
+from __future__ import annotations
+
+import importlib
+import json
+import mmap
+import os
+import struct
+import sys
+from array import array
+from collections import OrderedDict
+from typing import TYPE_CHECKING, BinaryIO, Dict, List, Set
+
+from fibers.tree.node import LazyContent, LazyAttrs
+from fibers.tree.traversal import walk
+
+if TYPE_CHECKING:
+    from fibers.tree import Node
+
+"""
+# Binary tree format
+
+`save_sub_tree` writes the tree while walking it, in chunks of `CHUNK_NODES` nodes,
+so that memory use does not depend on the size of the tree. `read_tree` parses the
+file through `mmap` chunk by chunk, keeping only packed arrays until the nodes are built. With `lazy=True`, only the
+structure and titles are loaded; contents and attrs stay in the mapped file until they
+are accessed, and at most `cache_size` decoded contents are kept in memory.
+
+Layout (all integers little-endian):
+
+    MAGIC | u16 version | u16 reserved
+    chunk*: u8 tag | u32 payload size | payload
+
+A file is a base segment holding the whole tree, optionally followed by delta segments
+appended by `fibers.tree.journal.TreeJournal`. Each segment ends with an END chunk, and
+node and string indices are local to their segment.
+
+Chunks:
+- DELTA: empty. Starts a delta segment.
+- STRINGS: u32 n | u32 lengths[n] | utf-8 bytes. Appended to the string table.
+- NODES: u32 n | u8 flags | u64 ids[n] | (u64 id_highs[n] if flags & WIDE_IDS)
+  | (u32 indices[n] if flags & INDEXED) | u32 titles[n] | u32 contents[n]
+  | u32 n_children[n] | u32 children[] | u32 n_parents[n] | u32 parents[]
+  In the base segment nodes are numbered in the order they are written. Titles and
+  contents index the string table, children and parents index the nodes.
+- PARENTS: same layout as the adjacency part of NODES, prefixed by the node indices.
+  Replaces the parents of nodes whose parents were not numbered yet when they were written.
+- ATTRS: u32 n | u32 nodes[n] | u32 attr_classes[n] | u32 payloads[n]
+  The class is `module:qualname` and the payload is the JSON of `Attr.serialize()`, both as strings.
+- REFS: u32 n | u8 flags | u64 ids[n] | (u64 id_highs[n]) | u32 indices[n]
+  Nodes used by a delta segment but saved in an earlier segment.
+- END: u32 root | u32 n_nodes
+
+A delta segment replaces the nodes it contains. Segments without END (e.g. from an
+interrupted save) are ignored.
+
+Files written by older versions (a `dill` pickle) are still readable.
+"""
+
+MAGIC = b"FIBTREE\x00"
+VERSION = 2
+CHUNK_NODES = 4096
+# Only short strings (mostly titles) are interned, to keep the writer's memory bounded
+MAX_INTERNED_LEN = 256
+
+TAG_END = 0
+TAG_STRINGS = 1
+TAG_NODES = 2
+TAG_PARENTS = 3
+TAG_ATTRS = 4
+TAG_DELTA = 5
+TAG_REFS = 6
+
+FLAG_WIDE_IDS = 1
+FLAG_INDEXED = 2
+
+_HEADER = struct.Struct("<8sHH")
+_CHUNK_HEADER = struct.Struct("<BI")
+_U32 = struct.Struct("<I")
+_U64_MASK = (1 << 64) - 1
+
+
+def _u32_array(values=()) -> array:
+    return array("I", values)
+
+
+def _to_bytes(values: array) -> bytes:
+    if sys.byteorder == "big":
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def _from_bytes(typecode: str, data) -> array:
+    values = array(typecode)
+    values.frombytes(data)
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values
+
+
+"""
+## Writing
+"""
+
+
+class TreeWriter:
+    """
+    Write nodes to a binary stream in chunks.
+    :param delta: Write a delta segment, to be appended to an existing file.
+    Nodes can then be written in any order
+    :param mark_clean: Clear the dirty flag of the written nodes
+    """
+
+    def __init__(self, f: BinaryIO, delta=False, mark_clean=False):
+        self.f = f
+        self.delta = delta
+        self.mark_clean = mark_clean
+        self.node_index: Dict[Node, int] = {}
+        self.interned: Dict[str, int] = {}
+        self.n_strings = 0
+        # Nodes with parents that were not numbered when they were written
+        self.late_parents: List[Node] = []
+        self.n_written = 0
+        # Only tracked for delta segments, where the other nodes are written as references
+        self.written: Set[Node] = set()
+        self._reset_chunk()
+        if delta:
+            self._write_chunk(TAG_DELTA, [])
+        else:
+            f.write(_HEADER.pack(MAGIC, VERSION, 0))
+
+    def _reset_chunk(self):
+        self.new_strings: List[bytes] = []
+        self.ids = array("Q")
+        self.id_highs = array("Q")
+        self.indices = _u32_array()
+        self.titles = _u32_array()
+        self.contents = _u32_array()
+        self.n_children = _u32_array()
+        self.children = _u32_array()
+        self.n_parents = _u32_array()
+        self.parents = _u32_array()
+        self.attr_nodes = _u32_array()
+        self.attr_classes = _u32_array()
+        self.attr_payloads = _u32_array()
+
+    def index_of(self, node: Node) -> int:
+        index = self.node_index.get(node)
+        if index is None:
+            index = len(self.node_index)
+            self.node_index[node] = index
+        return index
+
+    def add_string(self, s: str) -> int:
+        if len(s) <= MAX_INTERNED_LEN:
+            index = self.interned.get(s)
+            if index is not None:
+                return index
+            self.interned[s] = self.n_strings
+        self.new_strings.append(s.encode("utf-8"))
+        self.n_strings += 1
+        return self.n_strings - 1
+
+    def write_node(self, node: Node):
+        """
+        Write `node`. In the base segment, nodes must be written in the order of their index,
+        so the children of a node should be written after it, in order (e.g. BFS).
+        """
+        index = self.index_of(node)
+        if self.delta:
+            self.written.add(node)
+            self.indices.append(index)
+        else:
+            assert index == self.n_written, "Nodes must be written in the order they are numbered"
+        self.ids.append(node.node_id & _U64_MASK)
+        self.id_highs.append(node.node_id >> 64)
+        self.titles.append(self.add_string(node.title))
+        self.contents.append(self.add_string(node.content))
+        # Read without creating the child lists of the leaves
+        children = node._child_list or ()
+        self.n_children.append(len(children))
+        self.children.extend(self.index_of(child) for child in children)
+        if self.delta:
+            parents = [self.index_of(parent) for parent in node.parents]
+        else:
+            parents = [self.node_index.get(parent) for parent in node.parents]
+            if None in parents:
+                self.late_parents.append(node)
+                parents = [parent for parent in parents if parent is not None]
+        self.n_parents.append(len(parents))
+        self.parents.extend(parents)
+        for attr_class, attr in node.read_attrs().items():
+            payload = attr.serialize()
+            if payload is None:
+                continue
+            self.attr_nodes.append(index)
+            self.attr_classes.append(self.add_string(f"{attr_class.__module__}:{attr_class.__qualname__}"))
+            self.attr_payloads.append(self.add_string(json.dumps(payload)))
+        if self.mark_clean:
+            node.dirty = False
+        self.n_written += 1
+        if len(self.ids) >= CHUNK_NODES:
+            self.flush()
+
+    def _write_chunk(self, tag: int, parts: List[bytes]):
+        self.f.write(_CHUNK_HEADER.pack(tag, sum(len(part) for part in parts)))
+        for part in parts:
+            self.f.write(part)
+
+    def _id_parts(self, ids: array, id_highs: array, flags: int):
+        wide = any(id_highs)
+        parts = [bytes([flags | (FLAG_WIDE_IDS if wide else 0)]), _to_bytes(ids)]
+        if wide:
+            parts.append(_to_bytes(id_highs))
+        return parts
+
+    def flush(self):
+        if len(self.new_strings) > 0:
+            lengths = _u32_array(len(s) for s in self.new_strings)
+            self._write_chunk(TAG_STRINGS, [_U32.pack(len(lengths)), _to_bytes(lengths)] + self.new_strings)
+        if len(self.ids) > 0:
+            parts = [_U32.pack(len(self.ids))]
+            parts += self._id_parts(self.ids, self.id_highs, FLAG_INDEXED if self.delta else 0)
+            if self.delta:
+                parts.append(_to_bytes(self.indices))
+            parts += [_to_bytes(values) for values in (self.titles, self.contents, self.n_children,
+                                                       self.children, self.n_parents, self.parents)]
+            self._write_chunk(TAG_NODES, parts)
+        if len(self.attr_nodes) > 0:
+            self._write_chunk(TAG_ATTRS, [_U32.pack(len(self.attr_nodes))] + [
+                _to_bytes(values) for values in (self.attr_nodes, self.attr_classes, self.attr_payloads)])
+        self._reset_chunk()
+
+    def close(self, root: Node):
+        self.index_of(root)
+        self.flush()
+        if len(self.late_parents) > 0:
+            nodes, n_parents, parents = _u32_array(), _u32_array(), _u32_array()
+            for node in self.late_parents:
+                node_parents = [self.node_index[parent] for parent in node.parents if parent in self.node_index]
+                nodes.append(self.node_index[node])
+                n_parents.append(len(node_parents))
+                parents.extend(node_parents)
+            self._write_chunk(TAG_PARENTS, [_U32.pack(len(nodes))] + [
+                _to_bytes(values) for values in (nodes, n_parents, parents)])
+        if self.delta:
+            refs = [node for node in self.node_index if node not in self.written]
+            if len(refs) > 0:
+                ids = array("Q", (node.node_id & _U64_MASK for node in refs))
+                id_highs = array("Q", (node.node_id >> 64 for node in refs))
+                indices = _u32_array(self.node_index[node] for node in refs)
+                self._write_chunk(TAG_REFS, [_U32.pack(len(refs))] + self._id_parts(ids, id_highs, 0)
+                                  + [_to_bytes(indices)])
+        self._write_chunk(TAG_END, [_U32.pack(self.node_index[root]), _U32.pack(self.n_written)])
+
+
+def dump_tree(root: Node, f: BinaryIO, mark_clean=False):
+    """
+    Write the subtree of `root` to the binary stream `f`.
+    """
+    writer = TreeWriter(f, mark_clean=mark_clean)
+    # In BFS the nodes come out in the order they are discovered,
+    # which is the order `TreeWriter.index_of` numbers them
+    for node in walk(root, "bfs"):
+        writer.write_node(node)
+    writer.close(root)
+
+
+def save_tree(root: Node, path: str):
+    # Write to a new file, so that trees lazily loaded from `path` keep their mapping
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        dump_tree(root, f, mark_clean=True)
+    os.replace(tmp_path, path)
+
+
+"""
+## Reading
+"""
+
+
+def iter_chunks(buffer, offset=_HEADER.size):
+    """
+    :return: An iterator of (tag, payload, payload offset) with the payloads as memoryview slices of `buffer`
+    """
+    view = memoryview(buffer)
+    while offset + _CHUNK_HEADER.size <= len(view):
+        tag, size = _CHUNK_HEADER.unpack_from(view, offset)
+        offset += _CHUNK_HEADER.size
+        if offset + size > len(view):
+            # A chunk cut by an interrupted write
+            return
+        yield tag, view[offset:offset + size], offset
+        offset += size
+
+
+def _read_arrays(payload, offset: int, typecode: str, lengths):
+    """
+    Read one array per length in `lengths`, one after another.
+    :return: The list of arrays and the offset after them
+    """
+    size = array(typecode).itemsize
+    arrays = []
+    for length in lengths:
+        arrays.append(_from_bytes(typecode, payload[offset:offset + length * size]))
+        offset += length * size
+    return arrays, offset
+
+
+def _read_ids(payload, offset: int, n: int):
+    """
+    Read the flags and ids at `offset`.
+    :return: The flags, the list of ids and the offset after them
+    """
+    flags = payload[offset]
+    (ids,), offset = _read_arrays(payload, offset + 1, "Q", [n])
+    if flags & FLAG_WIDE_IDS:
+        (id_highs,), offset = _read_arrays(payload, offset, "Q", [n])
+        return flags, [low | (high << 64) for low, high in zip(ids, id_highs)], offset
+    return flags, ids, offset
+
+
+def _split(values: array, counts: array) -> List[array]:
+    res = []
+    start = 0
+    for count in counts:
+        res.append(values[start:start + count])
+        start += count
+    return res
+
+
+def is_tree_file(buffer) -> bool:
+    return bytes(buffer[:len(MAGIC)]) == MAGIC
+
+
+class StringTable:
+    """
+    The string table of a tree file. Strings are decoded from the buffer on demand.
+    """
+
+    def __init__(self, buffer, cache_size=0):
+        self.buffer = buffer
+        self.offsets = array("Q")
+        self.lengths = array("I")
+        # The decoded strings, least recently used first
+        self.cache: OrderedDict[int, str] = OrderedDict()
+        self.cache_size = cache_size
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def add_chunk(self, payload, payload_offset: int):
+        n = _U32.unpack_from(payload, 0)[0]
+        (lengths,), offset = _read_arrays(payload, _U32.size, "I", [n])
+        offset += payload_offset
+        for length in lengths:
+            self.offsets.append(offset)
+            offset += length
+        self.lengths.extend(lengths)
+
+    def decode(self, i: int) -> str:
+        offset = self.offsets[i]
+        return str(self.buffer[offset:offset + self.lengths[i]], "utf-8")
+
+    def get(self, i: int) -> str:
+        s = self.cache.get(i)
+        if s is not None:
+            self.cache.move_to_end(i)
+            return s
+        s = self.decode(i)
+        if self.cache_size > 0:
+            self.cache[i] = s
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return s
+
+
+class MappedContent(LazyContent):
+    __slots__ = ("strings", "index")
+
+    def __init__(self, strings: StringTable, index: int):
+        self.strings = strings
+        self.index = index
+
+    def materialize(self) -> str:
+        return self.strings.get(self.index)
+
+
+class MappedAttrs(LazyAttrs):
+    __slots__ = ("strings", "entries")
+
+    def __init__(self, strings: StringTable):
+        self.strings = strings
+        # Pairs of string indices of the attr class and the payload
+        self.entries: List[tuple] = []
+
+    def load(self, node: Node):
+        for attr_class, payload in self.entries:
+            _load_attr(node, self.strings.decode(attr_class), self.strings.decode(payload))
+
+
+def _load_attr(node: Node, attr_class: str, payload: str):
+    _import_attr_class(attr_class).deserialize(node, json.loads(payload))
+
+
+class _SegmentLoader:
+    """
+    Collect the chunks of one segment and apply them to the tree at its END chunk.
+    """
+
+    def __init__(self, strings: StringTable, nodes_by_id: Dict[int, Node], lazy: bool):
+        self.strings = strings
+        self.string_base = len(strings)
+        self.nodes_by_id = nodes_by_id
+        self.lazy = lazy
+        # Titles are interned by the writer, so they are decoded once
+        self.titles_decoded: Dict[int, str] = {}
+        # (local index, id, title, content, children, parents) of the written nodes
+        self.records: List[tuple] = []
+        self.late_parents: Dict[int, array] = {}
+        self.attrs: List[tuple] = []
+        self.refs: Dict[int, int] = {}
+
+    def add_nodes(self, payload):
+        n = _U32.unpack_from(payload, 0)[0]
+        flags, ids, offset = _read_ids(payload, _U32.size, n)
+        if flags & FLAG_INDEXED:
+            (indices,), offset = _read_arrays(payload, offset, "I", [n])
+        else:
+            indices = range(len(self.records), len(self.records) + n)
+        (titles, contents, n_children), offset = _read_arrays(payload, offset, "I", [n, n, n])
+        (children, n_parents), offset = _read_arrays(payload, offset, "I", [sum(n_children), n])
+        (parents,), offset = _read_arrays(payload, offset, "I", [sum(n_parents)])
+        self.records.extend(zip(indices, ids, titles, contents,
+                                _split(children, n_children), _split(parents, n_parents)))
+
+    def add_late_parents(self, payload):
+        n = _U32.unpack_from(payload, 0)[0]
+        (node_indices, n_parents), offset = _read_arrays(payload, _U32.size, "I", [n, n])
+        (parents,), offset = _read_arrays(payload, offset, "I", [sum(n_parents)])
+        self.late_parents.update(zip(node_indices, _split(parents, n_parents)))
+
+    def add_attrs(self, payload):
+        n = _U32.unpack_from(payload, 0)[0]
+        (node_indices, attr_classes, payloads), offset = _read_arrays(payload, _U32.size, "I", [n, n, n])
+        self.attrs.extend(zip(node_indices, attr_classes, payloads))
+
+    def add_refs(self, payload):
+        n = _U32.unpack_from(payload, 0)[0]
+        flags, ids, offset = _read_ids(payload, _U32.size, n)
+        (indices,), offset = _read_arrays(payload, offset, "I", [n])
+        self.refs.update(zip(indices, ids))
+
+    def _title(self, i: int) -> str:
+        title = self.titles_decoded.get(i)
+        if title is None:
+            title = self.titles_decoded[i] = self.strings.decode(self.string_base + i)
+        return title
+
+    def finish(self, root_index: int) -> Node:
+        from fibers.tree import Node
+        base = self.string_base
+        local: Dict[int, Node] = {}
+        for index, node_id in self.refs.items():
+            node = self.nodes_by_id.get(node_id)
+            if node is not None:
+                local[index] = node
+        for index, node_id, title, content, _, _ in self.records:
+            if self.lazy:
+                content = MappedContent(self.strings, base + content)
+            else:
+                content = self.strings.decode(base + content)
+            node = self.nodes_by_id.get(node_id)
+            if node is None:
+                node = Node(self._title(title), content)
+                node.node_id = node_id
+                self.nodes_by_id[node_id] = node
+            else:
+                node.title = self._title(title)
+                node.content = content
+                node.attrs = {}
+            local[index] = node
+        for index, _, _, _, children, parents in self.records:
+            node = local[index]
+            parents = self.late_parents.get(index, parents)
+            if len(children) > 0 or node._child_list is not None:
+                node.children = [local[i] for i in children if i in local]
+            node.parents = [local[i] for i in parents if i in local]
+        for index, attr_class, payload in self.attrs:
+            node = local[index]
+            if not self.lazy:
+                _load_attr(node, self.strings.decode(base + attr_class), self.strings.decode(base + payload))
+                continue
+            if not isinstance(node._attrs, MappedAttrs):
+                node.attrs = MappedAttrs(self.strings)
+            node._attrs.entries.append((base + attr_class, base + payload))
+        for node in local.values():
+            node.dirty = False
+        return local[root_index]
+
+
+def load_tree(buffer, lazy=False, cache_size=1024) -> Node:
+    """
+    Build the tree stored in `buffer` (bytes, mmap or memoryview), replaying its delta segments.
+    :param lazy: Leave the contents and attrs in `buffer` until they are accessed.
+    `buffer` must then stay valid as long as the tree is used
+    :param cache_size: The number of decoded contents to keep in memory when `lazy` is true
+    :return: The root of the tree
+    """
+    magic, version, _ = _HEADER.unpack_from(buffer, 0)
+    if magic != MAGIC:
+        raise ValueError("Not a Fibers tree file")
+    if version > VERSION:
+        raise ValueError(f"Tree file version {version} is newer than supported ({VERSION})")
+
+    strings = StringTable(buffer, cache_size if lazy else 0)
+    nodes_by_id: Dict[int, Node] = {}
+    segment = _SegmentLoader(strings, nodes_by_id, lazy)
+    root = None
+    for tag, payload, payload_offset in iter_chunks(buffer):
+        if tag == TAG_STRINGS:
+            strings.add_chunk(payload, payload_offset)
+        elif tag == TAG_NODES:
+            segment.add_nodes(payload)
+        elif tag == TAG_PARENTS:
+            segment.add_late_parents(payload)
+        elif tag == TAG_ATTRS:
+            segment.add_attrs(payload)
+        elif tag == TAG_REFS:
+            segment.add_refs(payload)
+        elif tag == TAG_DELTA:
+            segment = _SegmentLoader(strings, nodes_by_id, lazy)
+        elif tag == TAG_END:
+            root = segment.finish(_U32.unpack_from(payload, 0)[0])
+    if root is None:
+        raise ValueError("Tree file is truncated")
+    return root
+
+
+def _import_attr_class(name: str):
+    module_name, qualname = name.split(":")
+    obj = importlib.import_module(module_name)
+    for part in qualname.split("."):
+        obj = getattr(obj, part)
+    return obj
+
+
+def read_tree(path: str, lazy=False, cache_size=1024) -> Node:
+    """
+    Read a tree saved by `save_tree`. See `load_tree` for the parameters.
+    With `lazy=True`, the file stays mapped until the tree is garbage collected.
+    """
+    with open(path, "rb") as f:
+        if len(f.read(len(MAGIC))) == 0:
+            raise ValueError(f"{path} is empty")
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if not is_tree_file(buffer):
+        with buffer:
+            return read_legacy_tree(buffer)
+    if lazy:
+        return load_tree(buffer, lazy=True, cache_size=cache_size)
+    try:
+        return load_tree(buffer)
+    finally:
+        try:
+            buffer.close()
+        except BufferError:
+            # The traceback of an error still holds views of the map. It is closed when they are collected
+            pass
+
+
+def read_legacy_tree(buffer) -> Node:
+    """
+    Read a tree saved by older versions with `dill`.
+    """
+    import dill
+    from fibers.tree import Node
+
+    node_dict, root_id = dill.loads(bytes(buffer))
+    nodes = {}
+    for node_id, node_data in node_dict.items():
+        node = Node(node_data["title"], node_data["content"])
+        node.node_id = node_id
+        nodes[node_id] = node
+    for node_id, node_data in node_dict.items():
+        node = nodes[node_id]
+        if len(node_data["children"]) > 0:
+            node.children = [nodes[child_id] for child_id in node_data["children"]]
+        node.parents = [nodes[parent_id] for parent_id in node_data["parents"] if parent_id in nodes]
+    return nodes[root_id]
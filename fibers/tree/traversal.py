@@ -0,0 +1,102 @@
+from __future__ import annotations
+
+from collections import deque
+from typing import TYPE_CHECKING, Callable, Iterable, Iterator, Literal
+
+if TYPE_CHECKING:
+    from fibers.tree import Node
+
+"""
+# Subtree traversal
+
+All the subtree iterators of `Node` are built on `walk`. It keeps its own stack
+instead of recursing, so deep trees do not hit the recursion limit, and each
+node is visited exactly once even when it has several parents in the subtree.
+The children are read without creating the child lists of the leaves.
+"""
+
+Order = Literal["pre", "post", "bfs"]
+
+
+def walk(root: Node, order: Order = "pre", max_depth: int = None,
+         prune: Callable[[Node], bool] = None, exclude_self=False,
+         with_depth=False) -> Iterator[Node]:
+    """
+    Iterate the subtree of `root`.
+    :param order: "pre" for parents before children, "post" for children before parents,
+    "bfs" for the shallowest nodes first
+    :param max_depth: Do not go deeper than this. `root` has depth 0
+    :param prune: If `prune(node)` is true, the children of `node` are not visited. `node` itself is
+    :param exclude_self: Do not output `root`
+    :param with_depth: Output `(node, depth)` pairs instead of nodes
+    :return: An iterator of nodes
+    """
+    if order == "pre":
+        nodes = _walk_pre(root, max_depth, prune)
+    elif order == "post":
+        nodes = _walk_post(root, max_depth, prune)
+    elif order == "bfs":
+        nodes = _walk_bfs(root, max_depth, prune)
+    else:
+        raise ValueError(f"Unknown traversal order {order}")
+    if exclude_self:
+        nodes = ((node, depth) for node, depth in nodes if depth != 0)
+    if not with_depth:
+        nodes = (node for node, depth in nodes)
+    return nodes
+
+
+def _children(node) -> Iterable[Node]:
+    return node._child_list or ()
+
+
+def _expandable(node, depth, max_depth, prune) -> bool:
+    if max_depth is not None and depth >= max_depth:
+        return False
+    return prune is None or not prune(node)
+
+
+def _walk_pre(root, max_depth, prune):
+    visited = {root}
+    stack = [(root, 0)]
+    while len(stack) > 0:
+        node, depth = stack.pop()
+        yield node, depth
+        if _expandable(node, depth, max_depth, prune):
+            # Push in reverse so that the first child is output first
+            for child in reversed(_children(node)):
+                if child not in visited:
+                    visited.add(child)
+                    stack.append((child, depth + 1))
+
+
+def _walk_post(root, max_depth, prune):
+    visited = {root}
+    children = iter(_children(root)) if _expandable(root, 0, max_depth, prune) else iter(())
+    stack = [(root, 0, children)]
+    while len(stack) > 0:
+        node, depth, children = stack[-1]
+        for child in children:
+            if child not in visited:
+                visited.add(child)
+                if _expandable(child, depth + 1, max_depth, prune):
+                    stack.append((child, depth + 1, iter(_children(child))))
+                else:
+                    stack.append((child, depth + 1, iter(())))
+                break
+        else:
+            stack.pop()
+            yield node, depth
+
+
+def _walk_bfs(root, max_depth, prune):
+    visited = {root}
+    queue = deque([(root, 0)])
+    while len(queue) > 0:
+        node, depth = queue.popleft()
+        yield node, depth
+        if _expandable(node, depth, max_depth, prune):
+            for child in _children(node):
+                if child not in visited:
+                    visited.add(child)
+                    queue.append((child, depth + 1))
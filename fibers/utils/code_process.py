@@ -56,14 +56,11 @@ def get_function_module_env(function_node: Node):
     :param function_node: The node of the function
     :return: Lines of text, in which each line is a name of an ancestor node
     """
-    ancestor_nodes = [function_node.parent]
-    while True:
-        last_parent = ancestor_nodes[-1]
-        last_parent_parent = last_parent.parent
-        if last_parent_parent.parent is None:
-            break
-        ancestor_nodes.append(last_parent_parent)
-        if get_type(last_parent) == "module":
+    ancestor_nodes = []
+    # Exclude the function itself and the root
+    for node in function_node.path_to_root()[1:-1]:
+        ancestor_nodes.append(node)
+        if get_type(node) == "module":
             break
 
     parent_nodes = ancestor_nodes[::-1]
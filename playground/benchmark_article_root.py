@@ -0,0 +1,37 @@
+import time
+
+from bs4 import BeautifulSoup
+
+from fibers.data_loader.html_to_tree import extract_article_root
+
+"""
+Benchmark of article root detection on div-heavy pages.
+The time per element should stay flat as the pages grow.
+"""
+
+
+def nested_page(depth: int) -> str:
+    # Deeply nested divs, each with a paragraph
+    return "<div><p>text</p>" * depth + "</div>" * depth
+
+
+def wide_page(n_divs: int) -> str:
+    # Many sibling divs, each with a few paragraphs
+    return "".join("<div><span>x</span><p>a</p><p>b</p></div>" for _ in range(n_divs))
+
+
+def benchmark(name: str, html: str):
+    soup = BeautifulSoup(f"<html><body>{html}</body></html>", "html.parser")
+    n_elements = sum(1 for _ in soup.descendants)
+    start = time.perf_counter()
+    extract_article_root(soup)
+    elapsed = time.perf_counter() - start
+    print(f"{name:>14} | {n_elements:>7} elements | {elapsed * 1e3:8.1f}ms"
+          f" | {elapsed / n_elements * 1e6:.2f}us per element")
+
+
+if __name__ == '__main__':
+    for n in [100, 300, 900]:
+        benchmark(f"nested {n}", nested_page(n))
+    for n in [1_000, 10_000, 100_000]:
+        benchmark(f"wide {n}", wide_page(n))
@@ -0,0 +1,48 @@
+import random
+import time
+
+from fibers.tree import Node
+
+"""
+Benchmark of structural edits on a node with many siblings.
+Each line reports the time per operation, which should stay flat as the number of siblings grows.
+"""
+
+
+def benchmark(n_siblings: int):
+    random.seed(0)
+    root = Node("root")
+    start = time.perf_counter()
+    children = [root.new_child(str(i)) for i in range(n_siblings)]
+    add_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for child in children:
+        assert child in root.children
+        child.index_in_siblings()
+    query_time = time.perf_counter() - start
+
+    to_remove = random.sample(children, n_siblings // 2)
+    start = time.perf_counter()
+    for i, child in enumerate(to_remove):
+        child.remove_self()
+        # Positional queries between removals hit the Fenwick tree path
+        if i % 10 == 0:
+            root.children[len(root.children) // 2].index_in_siblings()
+    remove_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for child in to_remove[:n_siblings // 10]:
+        child.change_parent(root)
+    move_time = time.perf_counter() - start
+
+    per_op = lambda t, n: f"{t / n * 1e6:.2f}us"
+    print(f"{n_siblings:>7} siblings | add {per_op(add_time, n_siblings)}"
+          f" | in+index {per_op(query_time, n_siblings)}"
+          f" | remove {per_op(remove_time, len(to_remove))}"
+          f" | change_parent {per_op(move_time, n_siblings // 10)}")
+
+
+if __name__ == '__main__':
+    for n in [1_000, 10_000, 100_000]:
+        benchmark(n)
@@ -0,0 +1,58 @@
+import os
+import sys
+import time
+
+from fibers.data_loader.html_to_tree import default_parser, html_to_tree
+from fibers.data_loader.markdown_to_tree import markdown_to_tree
+from fibers.testing.testing_trees.loader import curr_dir as testing_trees_dir, load_sample_src
+
+"""
+Check that the parser backends build the same trees, and compare their speed.
+The markdown samples in fibers/testing/testing_trees are always checked.
+Pass a number to also check that many QuALITY articles (downloaded on first use).
+
+python playground/parser_parity.py 50
+"""
+
+parsers = ["html.parser", default_parser]
+
+
+def tree_signature(root):
+    return [(node.title, node.content) for node in root.iter_subtree_with_dfs()]
+
+
+def compare(name, build):
+    signatures = {}
+    times = {}
+    for parser in parsers:
+        start = time.perf_counter()
+        signatures[parser] = tree_signature(build(parser))
+        times[parser] = time.perf_counter() - start
+    reference = signatures[parsers[0]]
+    same = all(signature == reference for signature in signatures.values())
+    timing = " | ".join(f"{parser} {t * 1e3:.1f}ms" for parser, t in times.items())
+    print(f"{'same' if same else 'DIFFERENT'} | {name} | {timing}")
+    return same, times
+
+
+def main(n_articles: int):
+    results = []
+    for file_name in sorted(os.listdir(testing_trees_dir)):
+        if file_name.endswith(".md"):
+            src = load_sample_src(file_name)
+            results.append(compare(file_name, lambda parser: markdown_to_tree(src, parser=parser)))
+    if n_articles > 0:
+        from fibers.testing.testing_nl_dataset.loader import iter_dataset
+        for i, article in enumerate(iter_dataset("QuALITY.v1.0.1.dev")):
+            if i == n_articles:
+                break
+            results.append(compare(f"QuALITY {i}",
+                                   lambda parser: html_to_tree(article["article"], parser=parser)[0]))
+    n_same = sum(same for same, _ in results)
+    print(f"{n_same}/{len(results)} trees are the same")
+    for parser in parsers:
+        print(f"{parser}: {sum(times[parser] for _, times in results):.2f}s in total")
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 0)
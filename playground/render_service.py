@@ -0,0 +1,55 @@
+import asyncio
+
+from fibers.gui.service import LocalClient, RenderService
+from fibers.tree import Node
+from fibers.tree.node_attr import Attr
+from fibers.tree.node_attr.base import MessageResult
+
+"""
+Drive the render service with a local client.
+Bursts of clicks on the counters are coalesced into a few updates,
+and the latency of the messages is printed at the end.
+"""
+
+
+class Counter(Attr):
+    def __init__(self, node: Node):
+        super().__init__(node)
+        self.count = 0
+
+    async def handle_message(self, message) -> MessageResult:
+        # Stand-in for slow work, e.g. a call to a model
+        await asyncio.sleep(0.001)
+        self.count += 1
+        self.node.content = f"Clicked {self.count} times"
+        return MessageResult().rerender(self.node).select(self.node)
+
+
+async def main():
+    root = Node("root")
+    counters = [root.new_child(f"counter {i}") for i in range(10)]
+    for node in counters:
+        Counter(node)
+    service = RenderService(root, coalesce_delay=0.005)
+    async with LocalClient(service) as client:
+        init = await client.receive()
+        print(f"init: {len(init['nodeDict'])} nodes")
+        n_updates = 0
+        for burst in range(20):
+            messages = [{"node_id": str(node.node_id), "id": f"{burst}-{i}"}
+                        for i, node in enumerate(counters) for _ in range(5)]
+            await asyncio.gather(*[client.send(message) for message in messages])
+            # The burst may be split when handling it outlasts the coalescing delay
+            n_received = 0
+            while n_received < len(messages):
+                update = await client.receive(timeout=1)
+                n_received += len(update["messageIds"])
+                n_updates += 1
+        print(f"{20 * 50} messages, {n_updates} updates")
+    await service.close()
+    for stage, stats in service.stats.summary().items():
+        print(stage, ", ".join(f"{key}={value:.2f}" for key, value in stats.items()))
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,64 @@
+from fibers.data_loader.bad_text_attr import BadText
+from fibers.gui.renderer import Renderer
+from fibers.tree import Node
+from fibers.tree.compact import CompactTree
+from fibers.tree.persistence import read_tree
+from fibers.tree.traversal import walk
+
+
+def build_tree():
+    root = Node("root")
+    for i in range(3):
+        section = root.new_child(f"section {i}")
+        for j in range(2):
+            section.new_child(f"paragraph {i}.{j}").be(f"text {i}.{j}")
+    BadText(root.children[0]).add_bad_reason("bad_title")
+    return root
+
+
+def titles(nodes):
+    return [node.title for node in nodes]
+
+
+def test_traversal():
+    root = build_tree()
+    view = CompactTree.from_node(root)
+    for order in ["pre", "post", "bfs"]:
+        assert titles(walk(view, order)) == titles(walk(root, order))
+    assert titles(view.iter_subtree(max_depth=1)) == titles(root.iter_subtree(max_depth=1))
+    assert view.find_loop() is None
+    leaf = view.children[2].children[1]
+    leaf.add_child(view)
+    assert titles(view.find_loop()) == ["root", "section 2", "paragraph 2.1"]
+
+
+def test_save_sub_tree(tmp_path):
+    view = CompactTree.from_node(build_tree())
+    path = str(tmp_path / "tree.fib")
+    view.save_sub_tree(path)
+    loaded = read_tree(path)
+    assert [(node.node_id, node.title, node.content) for node in loaded.iter_subtree_with_bfs()] == \
+           [(node.node_id, node.title, node.content) for node in view.iter_subtree_with_bfs()]
+    assert loaded.children[0].get_attr(BadText).bad_reasons == {"bad_title"}
+
+
+def test_reading_attrs_is_sparse():
+    view = CompactTree.from_node(build_tree())
+    Renderer().render_to_json(view)
+    assert not view.children[1].has_attr(BadText)
+    assert len(view.children[1].attrs) == 0
+    assert list(view.tree._attrs) == [view.children[0]._index]
+    BadText(view.children[1])
+    assert view.children[1].has_attr(BadText)
+
+
+def test_compact_drops_replaced_strings():
+    view = CompactTree.from_node(build_tree())
+    tree = view.tree
+    for i in range(10):
+        view.children[0].be(f"draft {i}")
+    assert len(tree.contents) > 10
+    tree.compact()
+    assert len(tree.contents) == len({node.content for node in view.iter_subtree_with_bfs()})
+    assert view.children[0].content == "draft 9"
+    assert titles(view.children) == ["section 0", "section 1", "section 2"]
@@ -0,0 +1,39 @@
+from fibers.data_loader.bad_text_attr import BadText
+from fibers.gui.renderer import Renderer
+from fibers.tree import Node
+from fibers.tree.node_attr.citing import Citing
+
+
+def build_tree():
+    root = Node("root")
+    for i in range(3):
+        BadText(root.new_child(f"node {i}").be(f"content {i}")).add_bad_reason("bad_title")
+    return root
+
+
+def test_reading_a_copy_shares_the_attrs():
+    root = build_tree()
+    clone = root.clone_sub_tree()
+    Renderer().render_to_json(clone)
+    for node, copy in zip(root.children, clone.children):
+        assert copy.has_attr(BadText)
+        assert copy.get_attr_or_none(BadText) is node.get_attr_or_none(BadText)
+
+
+def test_changing_a_copy_forks_the_attr():
+    root = build_tree()
+    Citing(root.children[0])
+    clone = root.clone_sub_tree()
+    node, copy = root.children[0], clone.children[0]
+    copy.get_attr(BadText).add_bad_reason("overlap_to_sibling")
+    assert node.get_attr(BadText).bad_reasons == {"bad_title"}
+    assert copy.get_attr(BadText).bad_reasons == {"bad_title", "overlap_to_sibling"}
+    # Only the changed attr is forked
+    assert copy.get_attr_or_none(Citing) is node.get_attr_or_none(Citing)
+    # A copy of the copy shares the forked attr, and forks it again when changing it
+    second = clone.clone_sub_tree().children[0]
+    assert second.get_attr_or_none(BadText) is copy.get_attr(BadText)
+    second.get_attr(BadText).remove_bad_reason("bad_title")
+    assert copy.get_attr(BadText).bad_reasons == {"bad_title", "overlap_to_sibling"}
+    assert set(second.attrs) == {BadText, Citing}
+    assert second.attrs[Citing].node is second
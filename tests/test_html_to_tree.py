@@ -0,0 +1,19 @@
+import html as html_lib
+
+from fibers.data_loader.html_to_tree import SoupInfo, html_to_tree, remove_attrs, remove_elements
+
+
+def soup_html(node):
+    return str(node.get_attr(SoupInfo).soup)
+
+
+def test_chained_transforms_keep_one_encoding():
+    html = "<div><h1>A</h1><p class='c'>a &amp; b <b>x</b></p><h2>B</h2><p>drop <span>s</span></p></div>"
+    root = html_to_tree(html, keep_soup=False)[0]
+    nodes = list(root.iter_subtree_with_bfs())
+    remove_attrs(root, [])
+    assert [node.content for node in nodes] == [html_lib.escape(soup_html(node)) for node in nodes]
+    # Only the last node changes, but all the contents are rendered unescaped again
+    remove_elements(root, ["span"])
+    assert [node.content for node in nodes] == [soup_html(node) for node in nodes]
+    assert "span" not in nodes[-1].content
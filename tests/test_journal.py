@@ -0,0 +1,102 @@
+import pytest
+
+from fibers.tree import Node
+from fibers.tree.journal import TreeJournal
+from fibers.tree.persistence import read_tree
+
+
+def signature(root: Node):
+    return [(node.node_id, node.title, node.content,
+             [child.node_id for child in node.children],
+             [parent.node_id for parent in node.parents])
+            for node in root.iter_subtree_with_bfs()]
+
+
+@pytest.fixture
+def tree():
+    root = Node("root")
+    for i in range(5):
+        section = root.new_child(f"section {i}")
+        for j in range(3):
+            section.new_child(f"paragraph {i}.{j}").be(f"text {i}.{j}")
+    return root
+
+
+def test_delta_replay(tmp_path, tree):
+    path = str(tmp_path / "tree.fib")
+    with TreeJournal(tree, path) as journal:
+        journal.save()
+        size = (tmp_path / "tree.fib").stat().st_size
+
+        tree.children[1].remove_self()
+        tree.children[0].title = "renamed"
+        new_node = tree.children[2].new_child("new").be("new text")
+        new_node.new_child("new leaf")
+        # Only the changed nodes and their new children are written
+        assert 0 < journal.save() < len(list(tree.iter_subtree_with_bfs()))
+        assert journal.n_segments == 1
+        assert (tmp_path / "tree.fib").stat().st_size > size
+        assert journal.save() == 0
+
+        tree.children[0].children[0].be("edited")
+        journal.save()
+    assert signature(read_tree(path)) == signature(tree)
+
+
+def test_reopen_and_continue(tmp_path, tree):
+    path = str(tmp_path / "tree.fib")
+    with TreeJournal(tree, path) as journal:
+        journal.save()
+    with TreeJournal.open(path) as journal:
+        journal.root.children[3].new_child("added later")
+        assert journal.save() == 2
+        expected = signature(journal.root)
+    assert signature(read_tree(path)) == expected
+
+
+def test_compaction_after_max_segments(tmp_path, tree):
+    path = str(tmp_path / "tree.fib")
+    with TreeJournal(tree, path, max_segments=2) as journal:
+        journal.save()
+        for i in range(3):
+            tree.children[0].title = f"title {i}"
+            journal.save()
+        # The third save rewrote the file instead of appending
+        assert journal.n_segments == 0
+    assert signature(read_tree(path)) == signature(tree)
+
+
+def test_truncated_delta_segment_is_ignored(tmp_path, tree):
+    path = tmp_path / "tree.fib"
+    with TreeJournal(tree, str(path)) as journal:
+        journal.save()
+        expected = signature(tree)
+        size = path.stat().st_size
+        tree.children[0].title = "lost"
+        tree.children[0].new_child("lost child")
+        journal.save()
+    data = path.read_bytes()
+    # Cut the last segment at several points, as an interrupted save would
+    for end in [size + 1, (size + len(data)) // 2, len(data) - 1]:
+        path.write_bytes(data[:end])
+        assert signature(read_tree(str(path))) == expected
+
+
+def test_snapshot_with_same_ids(tmp_path, tree):
+    path = str(tmp_path / "tree.fib")
+    with TreeJournal(tree, path) as journal:
+        journal.save()
+        tree.children[0].title = "v1"
+        assert journal.save() == 1
+        # The nodes of the snapshot have the ids of the journaled nodes, and must not hide them
+        snapshot = read_tree(path)
+        tree.children[0].title = "v2"
+        assert journal.save() == 1
+        assert snapshot.children[0].title == "v1"
+    assert signature(read_tree(path)) == signature(tree)
+
+
+def test_journal_closes_registry(tmp_path, tree):
+    with TreeJournal(tree, str(tmp_path / "tree.fib")):
+        assert Node.dirty_registry is not None
+    assert Node.dirty_registry is None
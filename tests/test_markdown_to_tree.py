@@ -0,0 +1,31 @@
+import pytest
+
+from fibers.data_loader.markdown_to_tree import iter_markdown_blocks, markdown_to_tree
+
+
+@pytest.mark.parametrize("src, blocks", [
+    ("Title\n---\ntext", [(2, "Title"), (0, "text")]),
+    ("Title\n===", [(1, "Title")]),
+    ("# Title #\n\ntext", [(1, "Title"), (0, "text")]),
+    ("```python\nx = 1\n```\n---", [(0, "```python\nx = 1\n```\n---")]),
+    ("> quote\n---", [(0, "> quote\n---")]),
+    ("- a\n- b\n---", [(0, "- a\n- b\n---")]),
+    ("    code\n---", [(0, "    code\n---")]),
+    ("```\n# not a heading\n\nstill code\n```", [(0, "```\n# not a heading\n\nstill code\n```")]),
+    ("text\n<div><div>\n# a\n\n</div>\n</div>\n# b", [(0, "text"), (0, "<div><div>\n# a\n\n</div>\n</div>"), (1, "b")]),
+    ("<hr>\n# a", [(0, "<hr>"), (1, "a")]),
+])
+def test_blocks(src, blocks):
+    assert list(iter_markdown_blocks(src)) == blocks
+
+
+def test_keep_markdown_sections():
+    src = "# A\n\nintro\n\n## B\n\n```\ncode\n```\n---\n\n# C\n\nend"
+    root = markdown_to_tree(src, title="doc", keep_markdown=True)
+    doc = root.children[0]
+    a, c = doc.children
+    assert (a.title, c.title) == ("A", "C")
+    intro, b = a.children
+    assert intro.content == "intro"
+    assert [child.content for child in b.children] == ["```\ncode\n```\n---"]
+    assert [child.content for child in c.children] == ["end"]
@@ -0,0 +1,61 @@
+import pytest
+
+from fibers.data_loader.html_to_tree import html_to_tree
+from fibers.data_loader.markdown_to_tree import markdown_to_tree
+from fibers.testing.testing_trees.loader import load_sample_src
+
+pytest.importorskip("lxml")
+
+parsers = ["html.parser", "lxml"]
+
+well_formed_pages = {
+    "document": "<html><head><title>Title</title></head><body><article><h1>A</h1><p>x &amp; y</p>"
+                "<h2>B</h2><p>z<br/>w</p><blockquote>quote</blockquote></article></body></html>",
+    "fragment": "<div><h1>Title</h1><p>one <b>bold</b></p><ul><li>a</li><li>b</li></ul>"
+                "<h2>Section</h2><p>text</p><img src='a.png'/></div>",
+    "nested_containers": "<main><div><h2>X</h2><p>a</p><p>b</p><p>c</p></div><div><p>d</p></div></main>",
+    "table": "<div><h1>T</h1><table><tr><td>1</td></tr></table><p>after</p></div>",
+    "entities": "<div><p>&lt;tag&gt; &copy; &#169; caf&eacute;</p></div>",
+    "headings_out_of_order": "<div><h3>deep</h3><p>a</p><h1>top</h1><p>b</p><h2>mid</h2><p>c</p></div>",
+}
+
+
+def signature(root):
+    return [(node.title, node.content) for node in root.iter_subtree_with_bfs()]
+
+
+def html_signature(html, parser):
+    return signature(html_to_tree(html, parser=parser, keep_soup=False)[0])
+
+
+@pytest.mark.parametrize("name", sorted(well_formed_pages))
+def test_html_parity(name):
+    html = well_formed_pages[name]
+    assert html_signature(html, "lxml") == html_signature(html, "html.parser")
+
+
+def test_markdown_parity():
+    src = load_sample_src("Feyerabend.md")
+    assert signature(markdown_to_tree(src, parser="lxml")) == signature(markdown_to_tree(src, parser="html.parser"))
+
+
+def test_markdown_sections_parity():
+    """
+    The native splitting of `keep_markdown` finds the headings Python-Markdown finds
+    """
+    src = "# A\n\n<div>\n# not a heading\n\ntext\n</div>\n\n## B\n\n<!--\n# comment\n-->\n# C\n\nend"
+
+    def headings(root):
+        return [node.title for node in root.iter_subtree_with_bfs() if len(node.title) > 0]
+
+    assert headings(markdown_to_tree(src, keep_markdown=True)) == headings(markdown_to_tree(src)) == ["A", "C", "B"]
+
+
+def test_malformed_pages_differ():
+    """
+    The parsers repair malformed html differently: lxml closes unclosed elements as browsers do,
+    while html.parser nests them. Trees of such pages change with the parser
+    """
+    html = "<div><h1>A</h1><p>one<p>two</div>"
+    assert html_signature(html, "lxml")[-2:] == [("", "one"), ("", "two")]
+    assert html_signature(html, "html.parser")[-1] == ("", "one<p>two</p>")
@@ -0,0 +1,105 @@
+import dill
+import pytest
+
+from fibers.data_loader.bad_text_attr import BadText
+from fibers.tree import Node
+from fibers.tree.node_id import use_id_allocator, uuid_allocator
+from fibers.tree.persistence import CHUNK_NODES, read_tree, save_tree
+
+
+def signature(root: Node):
+    return [(node.node_id, node.title, node.content,
+             [child.node_id for child in node.children],
+             [parent.node_id for parent in node.parents])
+            for node in root.iter_subtree_with_bfs()]
+
+
+def build_dag():
+    root = Node("root", "root content")
+    a = root.new_child("a").be("content of a")
+    b = root.new_child("b")
+    shared = a.new_child("shared").be("in a and b")
+    b.add_child(shared)
+    shared.new_child("leaf").be("leaf content")
+    BadText(a).add_bad_reason("bad_title")
+    return root
+
+
+def test_dag_round_trip(tmp_path):
+    root = build_dag()
+    path = str(tmp_path / "tree.fib")
+    save_tree(root, path)
+    loaded = read_tree(path)
+    assert signature(loaded) == signature(root)
+    a, b = loaded.children
+    # The shared node is loaded once, under both parents
+    assert a.children[0] is b.children[0]
+    assert a.get_attr(BadText).bad_reasons == {"bad_title"}
+    assert not any(node.dirty for node in loaded.iter_subtree_with_bfs())
+
+
+def test_round_trip_over_chunk_size(tmp_path):
+    root = Node("root")
+    parents = [root.new_child(f"section {i}") for i in range(4)]
+    for i in range(CHUNK_NODES * 2 + 5):
+        parents[i % 4].new_child(f"node {i}").be(f"content {i % 7}")
+    # A node whose second parent is written in a later chunk
+    late = parents[0].children[0]
+    parents[-1].children[-1].add_child(late)
+    path = str(tmp_path / "tree.fib")
+    save_tree(root, path)
+    loaded = read_tree(path)
+    assert signature(loaded) == signature(root)
+
+
+def test_wide_ids_round_trip(tmp_path):
+    with use_id_allocator(uuid_allocator):
+        root = build_dag()
+    path = str(tmp_path / "tree.fib")
+    save_tree(root, path)
+    assert signature(read_tree(path)) == signature(root)
+
+
+def test_lazy_loading_with_small_cache(tmp_path):
+    root = Node("root")
+    for i in range(50):
+        BadText(root.new_child(f"node {i}").be(f"content {i}")).add_bad_reason("overlap_to_sibling")
+    path = str(tmp_path / "tree.fib")
+    save_tree(root, path)
+    loaded = read_tree(path, lazy=True, cache_size=2)
+    # Read the contents twice, so that most of them are decoded again after being evicted
+    for _ in range(2):
+        assert [child.content for child in loaded.children] == [f"content {i}" for i in range(50)]
+    assert signature(loaded) == signature(root)
+    assert all(child.get_attr(BadText).bad_reasons == {"overlap_to_sibling"} for child in loaded.children)
+
+
+def test_legacy_dill_file(tmp_path):
+    root = build_dag()
+    node_dict = {}
+    for node in root.iter_subtree_with_dfs():
+        node_dict[node.node_id] = {
+            "title": node.title,
+            "content": node.content,
+            "children": [child.node_id for child in node.children],
+            "parents": [parent.node_id for parent in node.parents]
+        }
+    path = tmp_path / "tree.dill"
+    path.write_bytes(dill.dumps([node_dict, root.node_id]))
+    assert signature(read_tree(str(path))) == signature(root)
+
+
+def test_truncated_base_segment(tmp_path):
+    path = tmp_path / "tree.fib"
+    save_tree(build_dag(), str(path))
+    data = path.read_bytes()
+    path.write_bytes(data[:len(data) - 3])
+    with pytest.raises(ValueError):
+        read_tree(str(path))
+
+
+def test_empty_file(tmp_path):
+    path = tmp_path / "tree.fib"
+    path.write_bytes(b"")
+    with pytest.raises(ValueError):
+        read_tree(str(path))
@@ -0,0 +1,19 @@
+from fibers.gui.renderer import Renderer
+from fibers.tree import Node
+
+
+def test_changing_the_output_keeps_the_cache():
+    root = Node("root")
+    for i in range(3):
+        root.new_child(f"node {i}").be(f"content {i}")
+    renderer = Renderer()
+    expected = renderer.render_to_json(root)
+    node_dict = renderer.render_to_json(root)["nodeDict"]
+    for node_json in node_dict.values():
+        node_json["title"] = "changed"
+        node_json["tabs"]["content"] = "changed"
+        node_json["children"].append("changed")
+    assert renderer.render_to_json(root) == expected
+    page = renderer.page_json(root, root.children[:1], 0)
+    page["tabs"]["content"] = "changed"
+    assert renderer.node_json(root) == expected["nodeDict"][str(root.node_id)]